@@ -1,5 +1,6 @@
 import os
 import posixpath
+from Queue import Empty
 
 import click
 from flask import Blueprint, jsonify, request, g, current_app
@@ -45,17 +46,66 @@ def get_path_info():
 
 @bp.route('/recordinfo')
 def get_record_info():
-    db = g.admin_context.pad.db
+    """Returns information about a record and its children.  The children
+    can be paginated with `offset` and `limit`.  In the `lightweight` mode
+    the children are not loaded, instead their labels come from the source
+    infos and their visibility is unknown.
+    """
+    pad = g.admin_context.pad
+    db = pad.db
     tree_item = g.admin_context.tree.get(request.args['path'])
-    children = []
-    attachments = []
+    offset = request.args.get('offset', 0, type=int)
+    limit = request.args.get('limit', type=int)
+    lightweight = request.args.get('lightweight') in ('1', 'true')
     alts = []
 
-    for child in tree_item.iter_children():
-        if child.is_attachment:
-            attachments.append(child)
-        else:
-            children.append(child)
+    child_ids = tree_item.get_child_ids(include_attachments=False)
+    attachment_ids = tree_item.get_child_ids(include_pages=False)
+    end = None
+    if limit is not None:
+        end = offset + limit
+    child_paths = [posixpath.join(tree_item.path, x)
+                   for x in child_ids[offset:end]]
+    attachment_paths = [posixpath.join(tree_item.path, x)
+                        for x in attachment_ids]
+
+    if lightweight:
+        builder = current_app.lektor_info.get_builder(pad)
+        with builder.new_build_state() as build_state:
+            labels = build_state.get_source_info_labels(child_paths)
+        children = [{
+            'id': posixpath.basename(path),
+            'path': path,
+            'label': posixpath.basename(path),
+            'label_i18n': labels.get(path) or
+                {'en': posixpath.basename(path)},
+            'visible': None,
+        } for path in child_paths]
+        attachments = [{
+            'id': posixpath.basename(path),
+            'path': path,
+            'type': db.get_attachment_type(path),
+        } for path in attachment_paths]
+    else:
+        tree = g.admin_context.tree
+        children = []
+        for path in child_paths:
+            x = tree.get(path, persist=False)
+            children.append({
+                'id': x.id,
+                'path': x.path,
+                'label': x.id,
+                'label_i18n': x.label_i18n,
+                'visible': x.is_visible,
+            })
+        attachments = []
+        for path in attachment_paths:
+            x = tree.get(path, persist=False)
+            attachments.append({
+                'id': x.id,
+                'path': x.path,
+                'type': x.attachment_type,
+            })
 
     primary_alt = db.config.primary_alternative
     if primary_alt is not None:
@@ -75,18 +125,9 @@ def get_record_info():
         label_i18n=tree_item.label_i18n,
         exists=tree_item.exists,
         is_attachment=tree_item.is_attachment,
-        attachments=[{
-            'id': x.id,
-            'path': x.path,
-            'type': x.attachment_type,
-        } for x in attachments],
-        children=[{
-            'id': x.id,
-            'path': x.path,
-            'label': x.id,
-            'label_i18n': x.label_i18n,
-            'visible': x.is_visible,
-        } for x in children],
+        attachments=attachments,
+        children=children,
+        total_children=len(child_ids),
         alts=alts,
         can_have_children=tree_item.can_have_children,
         can_have_attachments=tree_item.can_have_attachments,
@@ -212,6 +253,7 @@ def upload_new_attachments():
             'original_filename': file.filename,
             'stored_filename': ts.add_attachment(file.filename, file),
         })
+    current_app.lektor_info.forget_record(ts.path)
 
     return jsonify({
         'bad_upload': False,
@@ -238,6 +280,7 @@ def add_new_record():
             exists = True
         else:
             ts.update(values.get('data') or {})
+    current_app.lektor_info.forget_record(path)
 
     return jsonify({
         'valid_id': True,
@@ -254,6 +297,7 @@ def delete_record():
         ts = g.admin_context.tree.edit(request.values['path'], alt=alt)
         with ts:
             ts.delete(delete_master=delete_master)
+        current_app.lektor_info.forget_record(ts.path)
     return jsonify(okay=True)
 
 
@@ -265,6 +309,7 @@ def update_raw_record():
     ts = g.admin_context.tree.edit(values['path'], alt=alt)
     with ts:
         ts.update(data)
+    current_app.lektor_info.forget_record(ts.path)
     return jsonify(path=ts.path)
 
 
@@ -312,6 +357,31 @@ def publish_build():
     return generator()
 
 
+@bp.route('/events')
+def artifact_events():
+    """Streams the names of the artifacts that were rebuilt so that the
+    preview can reload when the shown page changes.
+    """
+    info = current_app.lektor_info
+    @eventstream
+    def generator():
+        queue = info.listen()
+        try:
+            yield {'type': 'connected'}
+            while 1:
+                try:
+                    artifacts = queue.get(timeout=15)
+                except Empty:
+                    # Keeps the connection alive and lets us notice when
+                    # the client went away.
+                    yield {'type': 'keepalive'}
+                else:
+                    yield {'type': 'updated', 'artifacts': artifacts}
+        finally:
+            info.unlisten(queue)
+    return generator()
+
+
 @bp.route('/ping')
 def ping():
     return jsonify(
@@ -28,7 +28,14 @@ class AdminContext(object):
 
     @cached_property
     def pad(self):
-        return current_app.lektor_info.get_pad()
+        pad, self._pad_token = self.info.checkout_pad()
+        return pad
+
+    def release_pad(self):
+        """Gives the pad back to the lektor info if one was used."""
+        pad = self.__dict__.pop('pad', None)
+        if pad is not None:
+            self.info.release_pad(pad, self._pad_token)
 
     @cached_property
     def tree(self):
@@ -38,3 +45,10 @@ class AdminContext(object):
 @bp.before_app_request
 def find_common_info():
     g.admin_context = AdminContext()
+
+
+@bp.teardown_app_request
+def release_common_info(exc):
+    admin_context = getattr(g, 'admin_context', None)
+    if admin_context is not None:
+        admin_context.release_pad()
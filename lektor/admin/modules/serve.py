@@ -1,11 +1,10 @@
 import os
 import mimetypes
 import posixpath
-from cStringIO import StringIO
 from zlib import adler32
 
 from flask import Blueprint, current_app, abort, Response, request, \
-     render_template
+     render_template, g
 from werkzeug.datastructures import Headers
 from werkzeug.wsgi import wrap_file
 
@@ -13,10 +12,8 @@ from werkzeug.wsgi import wrap_file
 bp = Blueprint('serve', __name__)
 
 
-def rewrite_html_for_editing(fp, edit_url):
-    contents = fp.read()
-
-    button = '''
+def get_edit_button(edit_url):
+    return '''
     <style type="text/css">
       #lektor-edit-link {
         position: fixed;
@@ -63,10 +60,204 @@ def rewrite_html_for_editing(fp, edit_url):
         'edit_url': edit_url.encode('utf-8'),
     }
 
-    return StringIO(contents + button)
 
+def get_live_reload_script(events_url, site_root):
+    return '''
+    <script type="text/javascript">
+      (function() {
+        if (!window.EventSource) {
+          return;
+        }
+        var siteRoot = '%(site_root)s';
+
+        function getArtifactName(url) {
+          var link = document.createElement('a');
+          link.href = url;
+          var path = link.pathname;
+          if (link.host != document.location.host ||
+              path.indexOf(siteRoot) != 0) {
+            return null;
+          }
+          path = decodeURIComponent(path.substr(siteRoot.length));
+          if (path == '' || path.charAt(path.length - 1) == '/') {
+            path += 'index.html';
+          }
+          return path;
+        }
+
+        function getWatchedArtifacts() {
+          var rv = {};
+          var urls = [document.location.href];
+          var elements = document.querySelectorAll('link[href], [src]');
+          for (var i = 0; i < elements.length; i++) {
+            urls.push(elements[i].href || elements[i].src);
+          }
+          for (i = 0; i < urls.length; i++) {
+            var name = getArtifactName(urls[i]);
+            if (name !== null) {
+              rv[name] = true;
+            }
+          }
+          return rv;
+        }
+
+        var events = new EventSource('%(events_url)s');
+        events.onmessage = function(event) {
+          var data = JSON.parse(event.data);
+          if (!data || data.type != 'updated') {
+            return;
+          }
+          var watched = getWatchedArtifacts();
+          for (var i = 0; i < data.artifacts.length; i++) {
+            if (watched[data.artifacts[i]]) {
+              events.close();
+              document.location.reload();
+              return;
+            }
+          }
+        };
+      })();
+    </script>
+    ''' % {
+        'events_url': events_url.encode('utf-8'),
+        'site_root': site_root.encode('utf-8'),
+    }
+
+
+def get_injected_html(script_root):
+    """Returns the HTML that is appended to every page in the preview:
+    the edit button and the script that reloads the page once it or one
+    of the files it uses was rebuilt.
+    """
+    site_root = posixpath.join('/', script_root, '')
+    return get_edit_button(posixpath.join(site_root, 'admin/edit')) + \
+        get_live_reload_script(posixpath.join(site_root, 'admin/api/events'),
+                               site_root)
+
+
+def rewrite_html_for_editing(fp, injected_html, chunk_size=16 * 1024):
+    """Streams the HTML file in chunks and appends the injected HTML."""
+    try:
+        while 1:
+            chunk = fp.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        fp.close()
+    yield injected_html
+
+
+def get_file_etag(st, artifact_name=None):
+    """Returns an etag for a file.  For artifacts the checksum recorded by
+    the builder is used, so that rebuilding an artifact with the same
+    contents keeps the etag.  Other files fall back to their stat.
+    """
+    if artifact_name is not None:
+        builder = current_app.lektor_info.get_builder(g.admin_context.pad)
+        with builder.new_build_state() as build_state:
+            rv = build_state.get_artifact_checksum(artifact_name)
+        if rv is not None and tuple(rv[:2]) == (int(st.st_mtime),
+                                               st.st_size):
+            return 'lektor-%s' % rv[2]
+    return 'lektor-%x-%x-%x' % (st.st_ino, int(st.st_mtime * 1000),
+                                st.st_size)
+
+
+def iter_file_ranges(fp, ranges, chunk_size=16 * 1024):
+    """Streams the given ``(start, stop, prefix)`` ranges of a file.  The
+    prefix is emitted before the range and can be used for multipart
+    headers.
+    """
+    try:
+        for start, stop, prefix in ranges:
+            if prefix:
+                yield prefix
+            fp.seek(start)
+            remaining = stop - start
+            while remaining > 0:
+                chunk = fp.read(min(chunk_size, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+    finally:
+        fp.close()
+
+
+def get_requested_ranges(length):
+    """Returns the byte ranges requested for a file of the given length
+    as list of ``(start, stop)`` tuples.  If no ranges were requested
+    `None` is returned, if none of them can be satisfied the return
+    value is an empty list.
+    """
+    rng = request.range
+    if rng is None or rng.units != 'bytes':
+        return None
+    rv = []
+    for start, stop in rng.ranges:
+        if start < 0:
+            start = max(length + start, 0)
+            stop = length
+        elif stop is None or stop > length:
+            stop = length
+        if start < stop:
+            rv.append((start, stop))
+    return rv
+
+
+def make_range_response(rv, fp, length):
+    """Turns a full response for a file into a partial one if the client
+    requested byte ranges.
+    """
+    if_range = request.if_range
+    if if_range.etag is not None:
+        if if_range.etag != rv.get_etag()[0]:
+            return rv
+    elif if_range.date is not None and if_range.date != rv.last_modified:
+        return rv
+
+    ranges = get_requested_ranges(length)
+    if ranges is None:
+        return rv
 
-def send_file(filename):
+    if not ranges:
+        fp.close()
+        rv = Response(status=416)
+        rv.headers['Accept-Ranges'] = 'bytes'
+        rv.headers['Content-Range'] = 'bytes */%d' % length
+        return rv
+
+    rv.status_code = 206
+    if len(ranges) == 1:
+        start, stop = ranges[0]
+        rv.response = iter_file_ranges(fp, [(start, stop, None)])
+        rv.headers['Content-Range'] = 'bytes %d-%d/%d' % (
+            start, stop - 1, length)
+        rv.headers['Content-Length'] = stop - start
+        return rv
+
+    boundary = os.urandom(16).encode('hex')
+    parts = []
+    content_length = 0
+    for start, stop in ranges:
+        prefix = '%s--%s\r\nContent-Type: %s\r\n' \
+            'Content-Range: bytes %d-%d/%d\r\n\r\n' % (
+                parts and '\r\n' or '', boundary, rv.mimetype,
+                start, stop - 1, length)
+        parts.append((start, stop, prefix))
+        content_length += len(prefix) + stop - start
+    trailer = '\r\n--%s--\r\n' % boundary
+    parts.append((0, 0, trailer))
+    content_length += len(trailer)
+
+    rv.response = iter_file_ranges(fp, parts)
+    rv.headers['Content-Type'] = 'multipart/byteranges; boundary=%s' % boundary
+    rv.headers['Content-Length'] = content_length
+    return rv
+
+
+def send_file(filename, artifact_name=None):
     mimetype = mimetypes.guess_type(filename)[0]
     if mimetype is None:
         mimetype = 'application/octet-stream'
@@ -75,43 +266,38 @@ def send_file(filename):
 
     try:
         file = open(filename, 'rb')
-        mtime = os.path.getmtime(filename)
-        headers['Content-Length'] = os.path.getsize(filename)
+        st = os.fstat(file.fileno())
     except (IOError, OSError):
         abort(404)
 
-    rewritten = False
-    if mimetype == 'text/html':
-        rewritten = True
-        file = rewrite_html_for_editing(file,
-            edit_url=posixpath.join('/', request.script_root, 'admin/edit'))
-        del headers['Content-Length']
-
-    headers['Cache-Control'] = 'no-cache, no-store'
+    # Pages are always revalidated, but thanks to the etag that is cheap
+    # if they did not change since.
+    headers['Cache-Control'] = 'no-cache'
+    etag = get_file_etag(st, artifact_name)
 
-    data = wrap_file(request.environ, file)
+    if mimetype == 'text/html':
+        injected = get_injected_html(request.script_root)
+        data = rewrite_html_for_editing(file, injected)
+        headers['Content-Length'] = st.st_size + len(injected)
+        etag = '%s-%s' % (etag, adler32(injected) & 0xffffffff)
+    else:
+        data = wrap_file(request.environ, file)
+        headers['Content-Length'] = st.st_size
 
     rv = Response(data, mimetype=mimetype, headers=headers,
                   direct_passthrough=True)
+    rv.last_modified = int(st.st_mtime)
+    rv.set_etag(etag)
+    rv.make_conditional(request)
+    if rv.status_code == 304:
+        file.close()
 
-    if not rewritten:
-        # if we know the file modification date, we can store it as
-        # the time of the last modification.
-        if mtime is not None:
-            rv.last_modified = int(mtime)
-        rv.cache_control.public = True
-        try:
-            rv.set_etag('lektor-%s-%s-%s' % (
-                os.path.getmtime(filename),
-                os.path.getsize(filename),
-                adler32(
-                    filename.encode('utf-8') if isinstance(filename, basestring)
-                    else filename
-                ) & 0xffffffff,
-            ))
-        except OSError:
-            pass
-
+    # Byte ranges are supported for everything but the pages which are
+    # rewritten on the fly, so that media attachments can be seeked.
+    if mimetype != 'text/html':
+        rv.headers['Accept-Ranges'] = 'bytes'
+        if rv.status_code == 200:
+            rv = make_range_response(rv, file, st.st_size)
     return rv
 
 
@@ -124,13 +310,14 @@ def handle_build_failure(failure):
 def serve_artifact(path):
     li = current_app.lektor_info
 
-    pad = li.get_pad()
+    pad = g.admin_context.pad
 
     artifact_name, filename = li.resolve_artifact('/' + path, pad)
     if filename is None:
         abort(404)
 
-    if artifact_name is None:
+    is_artifact = artifact_name is not None
+    if not is_artifact:
         artifact_name = path.strip('/')
 
     # If there was a build failure for the given artifact, we want
@@ -141,4 +328,4 @@ def serve_artifact(path):
     if failure is not None:
         return handle_build_failure(failure)
 
-    return send_file(filename)
+    return send_file(filename, is_artifact and artifact_name or None)
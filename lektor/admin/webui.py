@@ -1,3 +1,10 @@
+import os
+import posixpath
+import threading
+import traceback
+from Queue import Queue
+from itertools import chain
+
 from flask import Flask, request, abort
 from flask.helpers import safe_join
 from werkzeug.utils import append_slash_redirect
@@ -7,25 +14,155 @@ from lektor.builder import Builder
 from lektor.buildfailures import FailureController
 from lektor.admin.modules import register_modules
 from lektor.reporter import CliReporter
+from lektor.watcher import Watcher
 
 
 class LektorInfo(object):
 
+    #: The number of warm pads that are kept around between requests.
+    max_idle_pads = 4
+
+    #: Warm pads that hold more records than this in their persistent
+    #: cache are thrown away instead of being reused so that the memory
+    #: use does not grow with every record visited.
+    max_pad_records = 2000
+
     def __init__(self, env, output_path, ui_lang='en', build_flags=None,
-                 verbosity=0):
+                 verbosity=0, stale_while_revalidate=False):
         self.env = env
         self.ui_lang = ui_lang
         self.output_path = output_path
         self.build_flags = build_flags
         self.verbosity = verbosity
+        self.stale_while_revalidate = stale_while_revalidate
+        self.watcher = None
+
+        self._lock = threading.Lock()
+        self._idle_pads = []
+        self._pad_generation = 0
+
+        # Maps request paths to the artifacts that were built for them
+        # together with the file generation at the time.  As long as no
+        # file changed since, the artifact can be served as it is.
+        self._file_generation = 0
+        self._known_artifacts = {}
+        self._revalidating = set()
+
+        # Queues of the clients that listen for rebuilt artifacts.
+        self._listeners = set()
+
+    def watch(self):
+        """Starts watching the project for changes.  This keeps the warm
+        pads up to date and enables serving current artifacts without
+        building them first.
+        """
+        if self.watcher is None:
+            self.watcher = Watcher(self.env, self.output_path,
+                                   callback=self.handle_file_change)
+            self.watcher.observer.start()
 
     def get_pad(self):
         return Database(self.env).new_pad()
 
+    def checkout_pad(self):
+        """Returns a warm pad for exclusive use until it's given back with
+        :meth:`release_pad`.  The return value is a tuple of the pad and a
+        token that has to be passed to :meth:`release_pad`.
+        """
+        with self._lock:
+            generation = self._pad_generation
+            if self._idle_pads:
+                return self._idle_pads.pop(), generation
+        return self.get_pad(), generation
+
+    def release_pad(self, pad, token):
+        """Gives a pad back so that later requests can reuse it.  If files
+        changed while the pad was in use or its cache grew too large, it's
+        discarded instead.  Without a watcher nothing would keep the pads
+        up to date, so they are never reused.
+        """
+        if self.watcher is None or \
+           len(pad.cache.persistent) > self.max_pad_records:
+            return
+        with self._lock:
+            if token == self._pad_generation and \
+               len(self._idle_pads) < self.max_idle_pads:
+                self._idle_pads.append(pad)
+
+    def handle_file_change(self, time, event_type, path):
+        """Invoked by the watcher for changed files.  For changes in the
+        content folder the affected records are evicted from the warm pads,
+        for any other change except to templates and assets the pads are
+        thrown away.
+        """
+        root_path = os.path.abspath(self.env.root_path)
+        path = os.path.relpath(os.path.abspath(path), root_path)
+        pieces = path.split(os.path.sep)
+
+        with self._lock:
+            self._file_generation += 1
+            if pieces[0] in ('templates', 'assets'):
+                return
+            self._pad_generation += 1
+            if pieces[0] != 'content':
+                del self._idle_pads[:]
+                return
+
+            # Evict the record the changed file belongs to together with
+            # everything below it and its parent which lists it.
+            self._evict_record('/'.join(pieces[1:-1]))
+
+    def forget_record(self, path):
+        """Forgets a record that was just changed through the admin
+        together with everything below it and its parent.  Unlike the
+        watcher this happens right away so that the next request sees
+        the change.
+        """
+        with self._lock:
+            self._file_generation += 1
+            self._pad_generation += 1
+            self._evict_record(path.strip('/'))
+
+    def _evict_record(self, record_path):
+        parent_path = posixpath.dirname(record_path)
+        for pad in self._idle_pads:
+            pad.cache.forget(record_path, children=True)
+            pad.cache.forget(parent_path)
+            pad.db._child_ids_cache.clear()
+
     def get_builder(self, pad=None):
         if pad is None:
             pad = self.get_pad()
-        return Builder(pad, self.output_path, build_flags=self.build_flags)
+        builder = Builder(pad, self.output_path, build_flags=self.build_flags)
+        builder.build_callbacks.append(self.notify_build)
+        return builder
+
+    def listen(self):
+        """Returns a queue that receives a list of artifact names whenever
+        artifacts were rebuilt or failed to build.  It has to be given back
+        with :meth:`unlisten` once the client goes away.
+        """
+        queue = Queue()
+        with self._lock:
+            self._listeners.add(queue)
+        return queue
+
+    def unlisten(self, queue):
+        with self._lock:
+            self._listeners.discard(queue)
+
+    def notify_build(self, build_state):
+        """Tells the listeners about the artifacts of a build state that
+        were just committed or failed.
+        """
+        artifacts = [x.artifact_name for x in chain(
+            build_state.updated_artifacts, build_state.failed_artifacts)]
+        if not artifacts:
+            return
+        with self._lock:
+            listeners = list(self._listeners)
+        for queue in listeners:
+            queue.put(artifacts)
 
     def get_failure_controller(self, pad=None):
         if pad is None:
@@ -37,14 +174,20 @@ class LektorInfo(object):
         Returns a tuple in the form ``(artifact_name, filename)`` where
         `artifact_name` can be `None` in case a file was targeted explicitly.
         """
+        rv = self._get_known_artifact(path)
+        if rv is not None:
+            return rv
+
         if pad is None:
             pad = self.get_pad()
 
         artifact_name = filename = None
+        generation = self._file_generation
 
         # We start with trying to resolve a source and then use the
         # primary
-        source = pad.resolve_url_path(path)
+        builder = self.get_builder(pad)
+        source = self._resolve_source(builder, path)
         if source is not None:
             # If the request path does not end with a slash but we
             # requested a URL that actually wants a trailing slash, we
@@ -55,29 +198,92 @@ class LektorInfo(object):
                source.url_path.endswith('/'):
                 return abort(append_slash_redirect(request.environ))
 
-            with CliReporter(self.env, verbosity=self.verbosity):
-                builder = self.get_builder(pad)
-                prog, _ = builder.build(source)
-
-            artifact = prog.primary_artifact
-            if artifact is not None:
-                artifact_name = artifact.artifact_name
-                filename = artifact.dst_filename
+            artifact_name, filename = self._build_source(
+                builder, source, path, generation)
 
         if filename is None:
             filename = safe_join(self.output_path, path.strip('/'))
 
         return artifact_name, filename
 
+    def _resolve_source(self, builder, path):
+        with builder.new_build_state() as build_state:
+            return builder.pad.resolve_url_path(path, build_state=build_state)
+
+    def _build_source(self, builder, source, path, generation):
+        with CliReporter(self.env, verbosity=self.verbosity):
+            prog, _ = builder.build(source)
+
+        artifact = prog.primary_artifact
+        if artifact is None:
+            return None, None
+
+        rv = artifact.artifact_name, artifact.dst_filename
+        if self.watcher is not None:
+            with self._lock:
+                self._known_artifacts[path] = rv + (generation,)
+        return rv
+
+    def _get_known_artifact(self, path):
+        """If an artifact was built for this path before and no file changed
+        since, it's returned without going through the builder.  With
+        `stale_while_revalidate` enabled outdated artifacts are returned
+        as well while they are rebuilt in the background.
+        """
+        if self.watcher is None:
+            return None
+        with self._lock:
+            known = self._known_artifacts.get(path)
+            generation = self._file_generation
+        if known is None:
+            return None
+
+        artifact_name, filename, built_generation = known
+        if not os.path.isfile(filename):
+            return None
+        if built_generation == generation:
+            return artifact_name, filename
+        if self.stale_while_revalidate:
+            self._revalidate_artifact(path)
+            return artifact_name, filename
+
+    def _revalidate_artifact(self, path):
+        with self._lock:
+            if path in self._revalidating:
+                return
+            self._revalidating.add(path)
+
+        def rebuild():
+            try:
+                generation = self._file_generation
+                pad, token = self.checkout_pad()
+                try:
+                    builder = self.get_builder(pad)
+                    source = self._resolve_source(builder, path)
+                    if source is not None:
+                        self._build_source(builder, source, path, generation)
+                finally:
+                    self.release_pad(pad, token)
+            except Exception:
+                traceback.print_exc()
+            finally:
+                with self._lock:
+                    self._revalidating.discard(path)
+
+        t = threading.Thread(target=rebuild)
+        t.setDaemon(True)
+        t.start()
+
 
 class WebUI(Flask):
 
     def __init__(self, env, debug=False, output_path=None, ui_lang='en',
-                 verbosity=0, build_flags=None):
+                 verbosity=0, build_flags=None, stale_while_revalidate=False):
         Flask.__init__(self, 'lektor.admin', static_url_path='/admin/static')
-        self.lektor_info = LektorInfo(env, output_path, ui_lang,
-                                      build_flags=build_flags,
-                                      verbosity=verbosity)
+        self.lektor_info = LektorInfo(
+            env, output_path, ui_lang, build_flags=build_flags,
+            verbosity=verbosity,
+            stale_while_revalidate=stale_while_revalidate)
         self.debug = debug
         self.config['PROPAGATE_EXCEPTIONS'] = True
 
@@ -1,10 +1,32 @@
 import os
+import re
 import stat
 import posixpath
 
 from lektor.sourceobj import SourceObject
 
 
+_fingerprinted_name_re = re.compile(r'^(.+)\.[0-9a-f]{8}(\.[^.]+)?$')
+
+
+def get_fingerprinted_name(name, fingerprint):
+    """Inserts a fingerprint into a filename, URL path or artifact name
+    in front of the extension (``style.css`` becomes
+    ``style.3f2a1b9c.css``).
+    """
+    base, ext = posixpath.splitext(name)
+    return '%s.%s%s' % (base, fingerprint, ext)
+
+
+def strip_fingerprint(name):
+    """Removes the fingerprint from a filename again.  If the name does
+    not look fingerprinted `None` is returned.
+    """
+    match = _fingerprinted_name_re.match(name)
+    if match is not None:
+        return match.group(1) + (match.group(2) or '')
+
+
 def get_asset(pad, filename, parent=None):
     env = pad.db.env
 
@@ -119,6 +141,12 @@ class Directory(Asset):
         if ext is not None:
             return get_asset(self.pad, name[:-len(prod_suffix)] + ext, parent=self)
 
+        # Fingerprinted asset URLs resolve to the asset they were made
+        # from.
+        name = strip_fingerprint(name)
+        if name is not None and self.pad.db.config.fingerprint_assets:
+            return self.get_child(name, from_url=True)
+
 
 class File(Asset):
     """Represents a static asset file."""
@@ -1,22 +1,28 @@
 import os
 import sys
+import json
 import stat
 import shutil
 import sqlite3
 import hashlib
 import tempfile
+import threading
 
 from contextlib import contextmanager
 from itertools import chain
 from collections import deque
 
+from lektor.db import Record
+from lektor.assets import get_fingerprinted_name
 from lektor.context import Context
 from lektor.build_programs import builtin_build_programs
 from lektor.reporter import reporter
-from lektor.sourcesearch import find_files
-from lektor.utils import prune_file_and_folder
+from lektor.sourcesearch import find_files, has_search_index
+from lektor.utils import prune_file_and_folder, make_relative_url, \
+     atomic_open
 from lektor.environment import PRIMARY_ALT
 from lektor.buildfailures import FailureController
+from lektor.precompress import Precompressor, precompress_formats
 
 from werkzeug.posixemulation import rename
 
@@ -70,10 +76,163 @@ def create_tables(con):
                 primary key (path, alt, lang)
             ) %s;
         ''' % without_rowid)
+        con.execute('''
+            create index if not exists source_info_title on source_info (
+                title collate nocase
+            );
+        ''')
+        con.execute('''
+            create table if not exists url_routes (
+                url_path text,
+                path text,
+                alt text,
+                page_num integer,
+                primary key (url_path)
+            ) %s;
+        ''' % without_rowid)
+        con.execute('''
+            create table if not exists artifact_checksums (
+                artifact text,
+                mtime integer,
+                size integer,
+                checksum text,
+                primary key (artifact)
+            ) %s;
+        ''' % without_rowid)
+        con.execute('''
+            create table if not exists published_artifacts (
+                server text,
+                artifact text,
+                checksum text,
+                primary key (server, artifact)
+            ) %s;
+        ''' % without_rowid)
+        con.execute('''
+            create table if not exists asset_fingerprints (
+                source text,
+                fingerprint text,
+                artifact text,
+                mtime integer,
+                size integer,
+                version integer,
+                primary key (source, fingerprint)
+            ) %s;
+        ''' % without_rowid)
+        con.execute('''
+            create table if not exists source_info_stamps (
+                path text,
+                alt text,
+                stamp text,
+                primary key (path, alt)
+            ) %s;
+        ''' % without_rowid)
+        create_search_index(con)
     finally:
         con.close()
 
 
+def create_search_index(con):
+    """Creates the full text index over the source infos that is used by
+    the admin to find pages.  This is a trigram index so that substrings
+    can be found like before.  If the SQLite version does not support
+    this, the index is not created and the search falls back to a scan.
+    """
+    if has_search_index(con.cursor()):
+        return
+    try:
+        con.execute('''
+            create virtual table source_info_search using fts5 (
+                title,
+                path,
+                alt unindexed,
+                lang unindexed,
+                type unindexed,
+                tokenize = 'trigram'
+            );
+        ''')
+    except sqlite3.OperationalError:
+        return
+
+    # The index is keyed by rowid which the source info table does not
+    # have, so we keep the mapping in a separate table.
+    con.execute('''
+        create table if not exists source_info_search_keys (
+            id integer primary key,
+            path text,
+            alt text,
+            lang text,
+            unique (path, alt, lang)
+        );
+    ''')
+    con.execute('''
+        insert or ignore into source_info_search_keys (path, alt, lang)
+            select path, alt, lang from source_info
+    ''')
+    con.execute('''
+        insert into source_info_search (rowid, title, path, alt, lang, type)
+            select k.id, s.title, s.path, s.alt, s.lang, s.type
+              from source_info s
+              join source_info_search_keys k
+                on k.path = s.path and k.alt = s.alt and k.lang = s.lang
+    ''')
+    con.commit()
+
+
+def _index_source_infos(cur, rows):
+    """Updates the search index for the given ``(path, alt, lang, type,
+    source, title)`` rows of the source info table.
+    """
+    # Only the last row written for a source info counts.
+    rows = dict((row[:3], row) for row in rows).values()
+    cur.executemany('''
+        insert or ignore into source_info_search_keys (path, alt, lang)
+            values (?, ?, ?)
+    ''', [row[:3] for row in rows])
+    key = '''(select id from source_info_search_keys
+               where path = ? and alt = ? and lang = ?)'''
+    cur.executemany('''
+        delete from source_info_search where rowid = %s
+    ''' % key, [row[:3] for row in rows])
+    cur.executemany('''
+        insert into source_info_search (rowid, title, path, alt, lang, type)
+            values (%s, ?, ?, ?, ?, ?)
+    ''' % key, [(path, alt, lang, title, path, alt, lang, type)
+                for path, alt, lang, type, source, title in rows])
+
+
+def _unindex_source_infos(cur, sources):
+    cur.execute('''
+        select k.id
+          from source_info s
+          join source_info_search_keys k
+            on k.path = s.path and k.alt = s.alt and k.lang = s.lang
+         where s.source in (%s)
+    ''' % ', '.join(['?'] * len(sources)), sources)
+    ids = [x[0] for x in cur.fetchall()]
+    if ids:
+        placeholders = ', '.join(['?'] * len(ids))
+        cur.execute('''
+            delete from source_info_search where rowid in (%s)
+        ''' % placeholders, ids)
+        cur.execute('''
+            delete from source_info_search_keys where id in (%s)
+        ''' % placeholders, ids)
+
+
+def make_output_change(type, artifact_name):
+    """Describes an artifact whose output was created, changed or pruned
+    for the change feed.  The URL is the one the artifact is served at.
+    """
+    url_path = '/' + artifact_name.strip('/')
+    if url_path.endswith('/index.html'):
+        url_path = url_path[:-10]
+    return {
+        'type': type,
+        'artifact': artifact_name,
+        'url_path': url_path,
+    }
+
+
 class BuildState(object):
 
     def __init__(self, builder, path_cache):
@@ -82,6 +241,7 @@ class BuildState(object):
         self.named_temporaries = set()
         self.updated_artifacts = []
         self.failed_artifacts = []
+        self.output_changes = []
         self.path_cache = path_cache
 
     @property
@@ -212,17 +372,83 @@ class BuildState(object):
         """Writes the source info into the database.  The source info is
         an instance of :class:`lektor.build_programs.SourceInfo`.
         """
-        reporter.report_write_source_info(info)
-        source = self.to_source_filename(info.filename)
+        self.write_source_infos([info])
+
+    def write_source_infos(self, infos):
+        """Writes many source infos into the database in one transaction."""
         con = self.connect_to_database()
         try:
             cur = con.cursor()
-            for lang, title in info.title_i18n.iteritems():
+            rows = []
+            for info in infos:
+                reporter.report_write_source_info(info)
+                source = self.to_source_filename(info.filename)
+                for lang, title in info.title_i18n.iteritems():
+                    rows.append((info.path, info.alt, lang, info.type,
+                                 source, title))
+            cur.executemany('''
+                insert or replace into source_info
+                    (path, alt, lang, type, source, title)
+                    values (?, ?, ?, ?, ?, ?)
+            ''', rows)
+            if rows and has_search_index(cur):
+                _index_source_infos(cur, rows)
+            con.commit()
+        finally:
+            con.close()
+
+    def get_source_info_labels(self, paths):
+        """Returns the titles of the source infos of the given paths as
+        dictionary of path to i18n labels.  The labels of the primary alt
+        are preferred.
+        """
+        rv = {}
+        alts = {}
+        paths = list(paths)
+        con = self.connect_to_database()
+        try:
+            cur = con.cursor()
+            # Stay below the limit of variables in a query.
+            for idx in xrange(0, len(paths), 500):
+                chunk = paths[idx:idx + 500]
                 cur.execute('''
-                    insert or replace into source_info
-                        (path, alt, lang, type, source, title)
-                        values (?, ?, ?, ?, ?, ?)
-                ''', [info.path, info.alt, lang, info.type, source, title])
+                    select path, alt, lang, title
+                      from source_info
+                     where path in (%s)
+                  order by alt = ? desc
+                ''' % ', '.join(['?'] * len(chunk)), chunk + [PRIMARY_ALT])
+                for path, alt, lang, title in cur.fetchall():
+                    if alts.setdefault(path, alt) == alt:
+                        rv.setdefault(path, {})[lang] = title
+            return rv
+        finally:
+            con.close()
+
+    def get_source_info_stamps(self):
+        """Returns a dictionary of ``(path, alt)`` to the stamp the source
+        files of that record had when its source info was last updated by
+        :meth:`Builder.update_all_source_infos`.
+        """
+        con = self.connect_to_database()
+        try:
+            cur = con.cursor()
+            cur.execute('''
+                select path, alt, stamp from source_info_stamps
+            ''')
+            return dict(((path, alt), stamp)
+                        for path, alt, stamp in cur.fetchall())
+        finally:
+            con.close()
+
+    def write_source_info_stamps(self, stamps):
+        """Remembers the stamps for the given ``(path, alt)`` keys."""
+        con = self.connect_to_database()
+        try:
+            con.executemany('''
+                insert or replace into source_info_stamps (path, alt, stamp)
+                    values (?, ?, ?)
+            ''', [(path, alt, stamp) for (path, alt), stamp
+                  in stamps.iteritems()])
             con.commit()
         finally:
             con.close()
@@ -241,10 +467,22 @@ class BuildState(object):
                 if not os.path.exists(fs_path):
                     to_clean.append(source)
             if to_clean:
+                if has_search_index(cur):
+                    _unindex_source_infos(cur, to_clean)
                 cur.execute('''
                     delete from source_info
                      where source in (%s)
                 ''' % ', '.join(['?'] * len(to_clean)), to_clean)
+                # The stamps of removed sources have to go too, otherwise
+                # the sources would be skipped if they show up again.
+                cur.execute('''
+                    delete from source_info_stamps
+                     where not exists (
+                        select 1 from source_info s
+                         where s.path = source_info_stamps.path
+                           and s.alt = source_info_stamps.alt
+                     )
+                ''')
                 con.commit()
         finally:
             con.close()
@@ -252,6 +490,46 @@ class BuildState(object):
         for source in to_clean:
             reporter.report_prune_source_info(source)
 
+    def get_url_route(self, url_path):
+        """Looks up the record that was last seen for a URL path.  If the
+        URL is known a tuple in the form ``(path, alt, page_num)`` is
+        returned, otherwise `None`.  The URL path is given without leading
+        and trailing slashes.
+        """
+        con = self.connect_to_database()
+        try:
+            cur = con.cursor()
+            cur.execute('''
+                select path, alt, page_num from url_routes
+                 where url_path = ?
+            ''', [url_path])
+            return cur.fetchone()
+        finally:
+            con.close()
+
+    def write_url_routes(self, routes, replace=False):
+        """Remembers the URL paths of records so that they can be
+        resolved without walking the tree.  The routes are given as
+        ``(url_path, path, alt, page_num)`` tuples.  If `replace` is set,
+        all previously known routes are discarded.
+        """
+        con = self.connect_to_database()
+        try:
+            cur = con.cursor()
+            if replace:
+                cur.execute('''
+                    delete from url_routes
+                ''')
+            cur.executemany('''
+                insert or replace into url_routes
+                    (url_path, path, alt, page_num)
+                    values (?, ?, ?, ?)
+            ''', [(url_path.strip('/'), path, alt, page_num)
+                  for url_path, path, alt, page_num in routes])
+            con.commit()
+        finally:
+            con.close()
+
     def remove_artifact(self, artifact_name):
         """Removes an artifact from the build state."""
         con = self.connect_to_database()
@@ -260,6 +538,259 @@ class BuildState(object):
             cur.execute('''
                 delete from artifacts where artifact = ?
             ''', [artifact_name])
+            cur.execute('''
+                delete from artifact_checksums where artifact = ?
+            ''', [artifact_name])
+            cur.execute('''
+                delete from asset_fingerprints where artifact = ?
+            ''', [artifact_name])
+            con.commit()
+            self.path_cache.asset_fingerprint_cache.clear()
+        finally:
+            con.close()
+
+    def get_asset_fingerprint(self, asset):
+        """Returns the fingerprint of an asset that goes into its
+        fingerprinted filename.  The fingerprints are kept in the build
+        state so that an asset is only hashed again after it changed and
+        so that older fingerprinted copies can be pruned later.
+        """
+        info = self.get_file_info(asset.source_filename)
+        cache = self.path_cache.asset_fingerprint_cache
+        cache_key = (asset.source_filename, info.mtime, info.size)
+        rv = cache.get(cache_key)
+        if rv is not None:
+            return rv
+        source = self.to_source_filename(asset.source_filename)
+        con = self.connect_to_database()
+        try:
+            cur = con.cursor()
+            cur.execute('''
+                select fingerprint from asset_fingerprints
+                 where source = ? and mtime = ? and size = ?
+            ''', [source, info.mtime, info.size])
+            row = cur.fetchone()
+            if row is not None:
+                cache[cache_key] = row[0]
+                return row[0]
+            fingerprint = info.checksum[:8]
+            artifact_name = self.artifact_name_from_destination_filename(
+                self.get_destination_filename(get_fingerprinted_name(
+                    asset.artifact_name, fingerprint)))
+            # The modification times are too coarse to order the
+            # versions, so they are counted.
+            cur.execute('''
+                insert or replace into asset_fingerprints
+                    (source, fingerprint, artifact, mtime, size, version)
+                    values (?, ?, ?, ?, ?, (
+                        select coalesce(max(version), 0) + 1
+                          from asset_fingerprints where source = ?))
+            ''', [source, fingerprint, artifact_name, info.mtime,
+                  info.size, source])
+            con.commit()
+            cache[cache_key] = fingerprint
+            return fingerprint
+        finally:
+            con.close()
+
+    def iter_stale_fingerprinted_artifacts(self, retention=0):
+        """Yields the fingerprinted copies of older versions of assets.
+        The copies of the latest `retention` older versions are kept so
+        that cached pages that still link to them keep working.
+        """
+        con = self.connect_to_database()
+        try:
+            cur = con.cursor()
+            cur.execute('''
+                select source, artifact from asset_fingerprints
+                 order by source, version desc
+            ''')
+            rows = cur.fetchall()
+        finally:
+            con.close()
+        last_source = None
+        for source, artifact_name in rows:
+            if source != last_source:
+                last_source = source
+                kept = 0
+            elif kept < retention:
+                kept += 1
+            else:
+                yield artifact_name
+
+    def register_sibling_artifacts(self, artifact_name, sibling_names):
+        """Registers files that were derived from an artifact next to
+        it.  They share the dependencies of the artifact so that they are
+        pruned together with it.
+        """
+        con = self.connect_to_database()
+        try:
+            cur = con.cursor()
+            for sibling_name in sibling_names:
+                cur.execute('''
+                    delete from artifacts where artifact = ?
+                ''', [sibling_name])
+                cur.execute('''
+                    insert into artifacts (artifact, source, source_mtime,
+                                           source_size, source_checksum,
+                                           is_dir, is_primary_source)
+                    select ?, source, source_mtime, source_size,
+                           source_checksum, is_dir, is_primary_source
+                      from artifacts where artifact = ?
+                ''', [sibling_name, artifact_name])
+                info = FileInfo(self.env, self.get_destination_filename(
+                    sibling_name))
+                cur.execute('''
+                    insert or replace into artifact_checksums
+                        (artifact, mtime, size, checksum)
+                        values (?, ?, ?, ?)
+                ''', [sibling_name, info.mtime, info.size, info.checksum])
+            con.commit()
+        finally:
+            con.close()
+
+    def get_sibling_artifacts(self, extensions):
+        """Returns the registered siblings of artifacts that have one of
+        the given extensions.  Siblings are told apart from artifacts that
+        merely share the name by having the same primary sources.
+        """
+        con = self.connect_to_database()
+        try:
+            cur = con.cursor()
+            rv = []
+            for ext in extensions:
+                cur.execute('''
+                    select distinct s.artifact from artifacts s, artifacts a
+                     where s.artifact like ?
+                       and a.artifact = substr(s.artifact, 1,
+                                               length(s.artifact) - ?)
+                       and a.source = s.source
+                       and a.is_primary_source and s.is_primary_source
+                ''', ['%' + ext, len(ext)])
+                rv.extend(x[0] for x in cur.fetchall())
+            return rv
+        finally:
+            con.close()
+
+    def get_artifact_checksum(self, artifact_name):
+        """Returns the ``(mtime, size, checksum)`` recorded for a single
+        artifact or `None` if it's not known.
+        """
+        con = self.connect_to_database()
+        try:
+            cur = con.cursor()
+            cur.execute('''
+                select mtime, size, checksum from artifact_checksums
+                 where artifact = ?
+            ''', [artifact_name])
+            return cur.fetchone()
+        finally:
+            con.close()
+
+    def get_artifact_checksums(self):
+        """Returns a dictionary that maps artifact names to the
+        ``(mtime, size, checksum)`` of the output file as it was recorded
+        when the artifact was last built.  The checksum is over the full
+        contents of the file so it can be used by publishers to detect
+        changes without having to read the file again.
+        """
+        con = self.connect_to_database()
+        try:
+            cur = con.cursor()
+            cur.execute('''
+                select artifact, mtime, size, checksum
+                  from artifact_checksums
+            ''')
+            return dict((row[0], row[1:]) for row in cur.fetchall())
+        finally:
+            con.close()
+
+    def update_artifact_checksums(self):
+        """Brings the recorded output checksums in line with the files
+        in the build folder.  Only files that were not written by the
+        builder or that changed since are hashed.
+        """
+        recorded = self.get_artifact_checksums()
+        updates = []
+        for artifact_name, full_path in self.iter_artifact_files():
+            info = FileInfo(self.env, full_path)
+            old = recorded.pop(artifact_name, None)
+            if old is None or old[:2] != (info.mtime, info.size):
+                updates.append((artifact_name, info.mtime, info.size,
+                                info.checksum))
+
+        if not updates and not recorded:
+            return
+        con = self.connect_to_database()
+        try:
+            cur = con.cursor()
+            cur.executemany('''
+                insert or replace into artifact_checksums
+                    (artifact, mtime, size, checksum)
+                    values (?, ?, ?, ?)
+            ''', updates)
+            cur.executemany('''
+                delete from artifact_checksums where artifact = ?
+            ''', [(x,) for x in recorded])
+            con.commit()
+        finally:
+            con.close()
+
+    def has_published_manifest(self, server):
+        """Checks if anything was recorded as published to a server."""
+        con = self.connect_to_database()
+        try:
+            cur = con.cursor()
+            cur.execute('''
+                select 1 from published_artifacts where server = ? limit 1
+            ''', [server])
+            return cur.fetchone() is not None
+        finally:
+            con.close()
+
+    def get_publish_delta(self, server):
+        """Compares the recorded output checksums with what was last
+        published to a server.  This returns a sorted list of
+        ``(artifact_name, checksum)`` tuples for everything that needs to
+        be uploaded.  Artifacts that need to be deleted on the server have
+        a checksum of `None`.
+        """
+        con = self.connect_to_database()
+        try:
+            cur = con.cursor()
+            cur.execute('''
+                select a.artifact, a.checksum
+                  from artifact_checksums a
+                  left join published_artifacts p
+                    on p.server = ? and p.artifact = a.artifact
+                 where p.checksum is null or p.checksum != a.checksum
+                union all
+                select p.artifact, null
+                  from published_artifacts p
+                 where p.server = ? and not exists (
+                    select 1 from artifact_checksums a
+                     where a.artifact = p.artifact)
+                order by 1
+            ''', [server, server])
+            return cur.fetchall()
+        finally:
+            con.close()
+
+    def record_published_artifacts(self, server, delta):
+        """Records a delta as returned by :meth:`get_publish_delta` as
+        published to the server.
+        """
+        con = self.connect_to_database()
+        try:
+            cur = con.cursor()
+            cur.executemany('''
+                insert or replace into published_artifacts
+                    (server, artifact, checksum) values (?, ?, ?)
+            ''', [(server, a, c) for a, c in delta if c is not None])
+            cur.executemany('''
+                delete from published_artifacts
+                 where server = ? and artifact = ?
+            ''', [(server, a) for a, c in delta if c is None])
             con.commit()
         finally:
             con.close()
@@ -316,41 +847,45 @@ class BuildState(object):
         finally:
             con.close()
 
+    def iter_artifact_files(self):
+        """Iterates over all files in the build folder that are not
+        ignored and yields their artifact names and full paths.
+        """
+        dst = self.builder.destination_path
+        for dirpath, dirnames, filenames in os.walk(dst):
+            dirnames[:] = [x for x in dirnames
+                           if not self.env.is_ignored_artifact(x)]
+            for filename in filenames:
+                if self.env.is_ignored_artifact(filename):
+                    continue
+                full_path = os.path.join(dst, dirpath, filename)
+                yield self.artifact_name_from_destination_filename(
+                    full_path), full_path
+
     def iter_unreferenced_artifacts(self, all=False):
         """Finds all unreferenced artifacts in the build folder and yields
         them.
         """
-        dst = os.path.join(self.builder.destination_path)
-
         con = self.connect_to_database()
         cur = con.cursor()
 
         try:
-            for dirpath, dirnames, filenames in os.walk(dst):
-                dirnames[:] = [x for x in dirnames
-                               if not self.env.is_ignored_artifact(x)]
-                for filename in filenames:
-                    if self.env.is_ignored_artifact(filename):
-                        continue
-                    full_path = os.path.join(dst, dirpath, filename)
-                    artifact_name = self.artifact_name_from_destination_filename(
-                        full_path)
-
-                    if all:
-                        yield artifact_name
-                        continue
+            for artifact_name, full_path in self.iter_artifact_files():
+                if all:
+                    yield artifact_name
+                    continue
 
-                    cur.execute('''
-                        select source from artifacts
-                         where artifact = ?
-                           and is_primary_source''', [artifact_name])
-                    sources = set(x[0] for x in cur.fetchall())
-
-                    # It's a bad artifact if there are no primary sources
-                    # or the primary sources do not exist.
-                    if not sources or not any(self.get_file_info(x).exists
-                                              for x in sources):
-                        yield artifact_name
+                cur.execute('''
+                    select source from artifacts
+                     where artifact = ?
+                       and is_primary_source''', [artifact_name])
+                sources = set(x[0] for x in cur.fetchall())
+
+                # It's a bad artifact if there are no primary sources
+                # or the primary sources do not exist.
+                if not sources or not any(self.get_file_info(x).exists
+                                          for x in sources):
+                    yield artifact_name
         finally:
             con.close()
 
@@ -717,15 +1252,40 @@ class Artifact(object):
 
     def _commit(self):
         con = None
+        change = None
+        written = False
         try:
             for op in self._pending_update_ops:
                 if con is None:
                     con = self.build_state.connect_to_database()
                 op(con)
 
-            if self._new_artifact_file is not None:
+            written = self._new_artifact_file is not None
+            if written:
+                # Record the checksum of the new output while it's most
+                # likely still in the page cache so that publishers do not
+                # have to hash the whole build folder again.
+                info = FileInfo(self.build_state.env,
+                                self._new_artifact_file)
+                values = [self.artifact_name, info.mtime, info.size,
+                          info.checksum]
                 rename(self._new_artifact_file, self.dst_filename)
                 self._new_artifact_file = None
+                if con is None:
+                    con = self.build_state.connect_to_database()
+                row = con.execute('''
+                    select checksum from artifact_checksums
+                     where artifact = ?
+                ''', [self.artifact_name]).fetchone()
+                if row is None:
+                    change = 'created'
+                elif row[0] != info.checksum:
+                    change = 'changed'
+                con.execute('''
+                    insert or replace into artifact_checksums
+                        (artifact, mtime, size, checksum)
+                        values (?, ?, ?, ?)
+                ''', values)
 
             if con is not None:
                 con.commit()
@@ -733,6 +1293,15 @@ class Artifact(object):
                 con = None
 
             self.build_state.updated_artifacts.append(self)
+            if change is not None:
+                self.build_state.output_changes.append(
+                    make_output_change(change, self.artifact_name))
+            if written:
+                self.build_state.path_cache.forget_asset_fingerprints(
+                    self.sources)
+                self.build_state.builder.precompressor.submit(
+                    self.artifact_name, self.dst_filename,
+                    changed=change is not None)
             self.build_state.builder.failure_controller.clear_failure(
                 self.artifact_name)
         finally:
@@ -773,11 +1342,50 @@ class Artifact(object):
         self.build_state.notify_failure(self, exc_info)
 
 
+class BuildLocks(object):
+    """Hands out one lock per artifact so that concurrent builds of the
+    same artifact (for instance from several requests to the dev server
+    and the background builder) are serialized.  Whoever gets the lock
+    second will find the artifact current and not build it again.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._locks = {}
+
+    @contextmanager
+    def lock(self, key):
+        with self._lock:
+            entry = self._locks.get(key)
+            if entry is None:
+                entry = self._locks[key] = [threading.RLock(), 0]
+            entry[1] += 1
+        entry[0].acquire()
+        try:
+            yield
+        finally:
+            entry[0].release()
+            with self._lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    self._locks.pop(key, None)
+
+
+#: The locks shared by all builders of the process.
+build_locks = BuildLocks()
+
+
 class PathCache(object):
 
+    #: The maximum number of entries in each of the URL caches.
+    url_cache_size = 10000
+
     def __init__(self, env):
         self.file_info_cache = {}
         self.source_filename_cache = {}
+        self.url_target_cache = {}
+        self.relative_url_cache = {}
+        self.asset_fingerprint_cache = {}
         self.env = env
 
     def to_source_filename(self, filename):
@@ -822,6 +1430,87 @@ class PathCache(object):
             self.file_info_cache[fn] = rv = FileInfo(self.env, fn)
         return rv
 
+    def forget_asset_fingerprints(self, filenames):
+        """Forgets the cached fingerprints of the given asset files.  This
+        is called whenever an artifact built from them is written.
+        """
+        filenames = set(filenames or ())
+        for key in list(self.asset_fingerprint_cache):
+            if key[0] in filenames:
+                del self.asset_fingerprint_cache[key]
+
+    def resolve_url_target(self, source, path, alt=None):
+        """Cached version of :meth:`SourceObject.resolve_url_target` that
+        only returns the URL path.  As the cache spans the entire build,
+        the dependency on the resolved record is tracked again for every
+        lookup.
+        """
+        if isinstance(path, basestring):
+            target = path
+        else:
+            target = (getattr(path, 'url_path', path),
+                      getattr(path, 'alt', None))
+        key = (source.path, source.alt, target, alt)
+        rv = self.url_target_cache.get(key)
+        if rv is None:
+            if len(self.url_target_cache) >= self.url_cache_size:
+                self.url_target_cache.clear()
+            rv = self.url_target_cache[key] = \
+                source.resolve_url_target(path, alt)
+        url_path, resolved = rv
+        if resolved is not None:
+            resolved.pad.db.track_record_dependency(resolved)
+        return url_path
+
+    def make_relative_url(self, base, target):
+        """Cached version of :func:`lektor.utils.make_relative_url`."""
+        key = (base, target)
+        rv = self.relative_url_cache.get(key)
+        if rv is None:
+            if len(self.relative_url_cache) >= self.url_cache_size:
+                self.relative_url_cache.clear()
+            rv = self.relative_url_cache[key] = \
+                make_relative_url(base, target)
+        return rv
+
+
+def _update_file_stamp(h, filename):
+    try:
+        st = os.stat(filename)
+    except OSError:
+        h.update('-\x00')
+    else:
+        h.update('%r %d\x00' % (st.st_mtime, st.st_size))
+
+
+def _get_source_stamp(source, base_stamp):
+    """Returns a stamp for the source files of a record that changes if
+    one of the files, the files of its parents (which can for instance
+    configure the slugs or models of their children) or the given base
+    stamp change.
+    """
+    h = hashlib.md5(base_stamp)
+    while source is not None:
+        for filename in source.iter_source_filenames():
+            _update_file_stamp(h, filename)
+        source = source.parent
+    return h.hexdigest()
+
+
+#: The builder and build state shared with the forked workers of a
+#: parallel source info update.
+_source_info_worker_state = None
+
+
+def _describe_source_record_in_worker(key):
+    builder, build_state = _source_info_worker_state
+    path, alt = key
+    source = builder.pad.get(path, alt=alt)
+    if source is None:
+        return None
+    return builder.get_build_program(
+        source, build_state).describe_source_record()
+
 
 def process_build_flags(flags):
     if isinstance(flags, dict):
@@ -845,6 +1534,13 @@ class Builder(object):
             pad.db.env.root_path, destination_path))
         self.meta_path = os.path.join(self.destination_path, '.lektor')
         self.failure_controller = FailureController(pad, self.destination_path)
+        self.precompressor = Precompressor(
+            self, pad.db.config.precompress_formats)
+        self._change_feed_started = False
+
+        #: Functions that are invoked with the build state after a source
+        #: was built.
+        self.build_callbacks = []
 
         try:
             os.makedirs(self.meta_path)
@@ -871,6 +1567,26 @@ class Builder(object):
         return sqlite3.connect(self.buildstate_database_filename,
                                timeout=10, check_same_thread=False)
 
+    @property
+    def change_feed_filename(self):
+        """The filename of the change feed of the last build."""
+        return os.path.join(self.meta_path, 'changes.jsonl')
+
+    def write_change_feed(self, changes):
+        """Writes the output changes of a build as JSON lines into the
+        change feed.  The first write of a builder replaces the feed and
+        later ones (like the prune that follows a build) append to it, so
+        the feed lists the changes of the last run only.
+        """
+        lines = [json.dumps(x) + '\n' for x in changes]
+        if self._change_feed_started:
+            with open(self.change_feed_filename, 'a') as f:
+                f.writelines(lines)
+        else:
+            with atomic_open(self.change_feed_filename, 'w') as f:
+                f.writelines(lines)
+            self._change_feed_started = True
+
     def touch_site_config(self):
         """Touches the site config which typically will trigger a rebuild."""
         try:
@@ -908,12 +1624,13 @@ class Builder(object):
         The return value is the ctx that was used to build this thing
         if it was built, or `None` otherwise.
         """
-        is_current = artifact.is_current
-        with reporter.build_artifact(artifact, build_func, is_current):
-            if not is_current:
-                with artifact.update() as ctx:
-                    build_func(artifact)
-                    return ctx
+        with build_locks.lock(artifact.dst_filename):
+            is_current = artifact.is_current
+            with reporter.build_artifact(artifact, build_func, is_current):
+                if not is_current:
+                    with artifact.update() as ctx:
+                        build_func(artifact)
+                        return ctx
 
     def update_source_info(self, prog, build_state):
         """Updates a single source info based on a program.  This is done
@@ -928,21 +1645,44 @@ class Builder(object):
         correspond to known artifacts.
         """
         path_cache = PathCache(self.env)
+        self.precompressor.wait()
         with reporter.build(all and 'clean' or 'prune', self):
             self.env.plugin_controller.emit(
                 'before-prune', builder=self, all=all)
+            changes = []
             with self.new_build_state(path_cache=path_cache) as build_state:
-                for aft in build_state.iter_unreferenced_artifacts(all=all):
+                to_prune = list(build_state.iter_unreferenced_artifacts(
+                    all=all))
+                # Siblings in formats that are no longer configured.
+                for aft in build_state.get_sibling_artifacts(
+                        self.precompressor.get_unused_extensions()):
+                    if aft not in to_prune:
+                        to_prune.append(aft)
+                # Only fingerprinted copies recorded in the build state
+                # are removed, together with their precompressed siblings.
+                retention = self.pad.db.config.fingerprint_retention
+                for aft in build_state.iter_stale_fingerprinted_artifacts(
+                        retention):
+                    for name in chain([aft], (aft + ext for ext, func
+                                              in precompress_formats
+                                              .itervalues())):
+                        if name not in to_prune and \
+                           build_state.artifact_exists(name):
+                            to_prune.append(name)
+                    build_state.remove_artifact(aft)
+                for aft in to_prune:
                     reporter.report_pruned_artifact(aft)
                     filename = build_state.get_destination_filename(aft)
                     prune_file_and_folder(filename, self.destination_path)
                     build_state.remove_artifact(aft)
+                    changes.append(make_output_change('pruned', aft))
                 build_state.prune_source_infos()
 
             if all:
                 build_state.vacuum()
+            self.write_change_feed(changes)
             self.env.plugin_controller.emit(
-                'after-prune', builder=self, all=all)
+                'after-prune', builder=self, all=all, changes=changes)
 
     def build(self, source, path_cache=None):
         """Given a source object, builds it."""
@@ -955,10 +1695,13 @@ class Builder(object):
                 prog.build()
                 if build_state.updated_artifacts:
                     self.update_source_info(prog, build_state)
+                for callback in self.build_callbacks:
+                    callback(build_state)
                 self.env.plugin_controller.emit(
                     'after-build', builder=self, build_state=build_state,
                     source=source, prog=prog)
-                return prog, build_state
+        self.precompressor.flush()
+        return prog, build_state
 
     def get_initial_build_queue(self):
         """Returns the initial build queue as deque."""
@@ -976,27 +1719,86 @@ class Builder(object):
         with reporter.build('build', self):
             self.env.plugin_controller.emit('before-build-all', builder=self)
             to_build = self.get_initial_build_queue()
-            while to_build:
-                source = to_build.popleft()
-                prog, build_state = self.build(source, path_cache=path_cache)
-                self.extend_build_queue(to_build, prog)
-                failures += len(build_state.failed_artifacts)
-            self.env.plugin_controller.emit('after-build-all', builder=self)
+            # Only the routes are kept, the records could take up a lot
+            # of memory for large sites.
+            routes = []
+            changes = []
+            with self.precompressor.batch():
+                while to_build:
+                    source = to_build.popleft()
+                    prog, build_state = self.build(source,
+                                                   path_cache=path_cache)
+                    self.extend_build_queue(to_build, prog)
+                    failures += len(build_state.failed_artifacts)
+                    changes.extend(build_state.output_changes)
+                    if isinstance(source, Record):
+                        routes.append((source.url_path, source.path,
+                                       source.alt, source.page_num))
+            with self.new_build_state(path_cache=path_cache) as build_state:
+                build_state.write_url_routes(routes, replace=True)
+            self.write_change_feed(changes)
+            self.env.plugin_controller.emit('after-build-all', builder=self,
+                                            changes=changes)
             if failures:
                 reporter.report_build_all_failure(failures)
         return failures
 
-    def update_all_source_infos(self):
+    def update_all_source_infos(self, jobs=1):
         """Fast way to update all source infos without having to build
-        everything.
+        everything.  Records whose source files and models did not change
+        since the last update are skipped.  If `jobs` is larger than one
+        the source infos are described in that many worker processes.
         """
         with reporter.build('source info update', self):
             with self.new_build_state() as build_state:
+                known_stamps = build_state.get_source_info_stamps()
+                h = hashlib.md5(repr(self.env.get_model_stamps()))
+                if self.env.project.project_file is not None:
+                    _update_file_stamp(h, self.env.project.project_file)
+                base_stamp = h.hexdigest()
+                infos = []
+                stamps = {}
+                to_describe = []
                 to_build = self.get_initial_build_queue()
                 while to_build:
                     source = to_build.popleft()
                     with reporter.process_source(source):
                         prog = self.get_build_program(source, build_state)
-                        self.update_source_info(prog, build_state)
+                        if not isinstance(source, Record):
+                            info = prog.describe_source_record()
+                            if info is not None:
+                                infos.append(info)
+                        else:
+                            key = (source.path, source.alt)
+                            if key not in stamps:
+                                stamps[key] = stamp = \
+                                    _get_source_stamp(source, base_stamp)
+                                if known_stamps.get(key) != stamp:
+                                    to_describe.append((key, prog))
                     self.extend_build_queue(to_build, prog)
+
+                infos.extend(self._describe_source_records(
+                    to_describe, build_state, jobs))
+                build_state.write_source_infos(infos)
+                build_state.write_source_info_stamps(dict(
+                    (key, stamps[key]) for key, prog in to_describe))
             build_state.prune_source_infos()
+
+    def _describe_source_records(self, progs, build_state, jobs):
+        if jobs <= 1 or len(progs) < 2 or not hasattr(os, 'fork'):
+            rv = (prog.describe_source_record() for key, prog in progs)
+        else:
+            # The workers are forked so they share the pad of the builder
+            # and only need to be told which record to describe.
+            global _source_info_worker_state
+            import multiprocessing
+            _source_info_worker_state = (self, build_state)
+            pool = multiprocessing.Pool(jobs)
+            try:
+                rv = pool.map(_describe_source_record_in_worker,
+                              [key for key, prog in progs],
+                              chunksize=64)
+            finally:
+                pool.terminate()
+                _source_info_worker_state = None
+        return [x for x in rv if x is not None]
@@ -127,12 +127,15 @@ def cli(ctx, project=None, language=None):
               'source info is used by the web admin panel to quickly find '
               'information about the source files (for instance jump to '
               'files).')
+@click.option('--source-info-jobs', type=int, default=1,
+              help='The number of processes used to update the source '
+              'infos.  The default is 1.')
 @buildflag
 @click.option('--profile', is_flag=True,
               help='Enable build profiler.')
 @pass_context
 def build_cmd(ctx, output_path, watch, prune, verbosity,
-              source_info_only, profile, build_flags):
+              source_info_only, source_info_jobs, profile, build_flags):
     """Builds the entire project into the final artifacts.
 
     The default behavior is to build the project into the default build
@@ -164,7 +167,7 @@ def build_cmd(ctx, output_path, watch, prune, verbosity,
         builder = Builder(env.new_pad(), output_path,
                           build_flags=build_flags)
         if source_info_only:
-            builder.update_all_source_infos()
+            builder.update_all_source_infos(jobs=source_info_jobs)
             return True
 
         if profile:
@@ -295,8 +298,12 @@ def deploy_cmd(ctx, server, output_path, **credentials):
               help='Increases the verbosity of the logging.')
 @buildflag
 @click.option('--browse', is_flag=True)
+@click.option('--stale-while-revalidate', is_flag=True,
+              help='Serve outdated pages right away and rebuild them in '
+              'the background instead of waiting for the build.')
 @pass_context
-def server_cmd(ctx, host, port, output_path, verbosity, build_flags, browse):
+def server_cmd(ctx, host, port, output_path, verbosity, build_flags, browse,
+               stale_while_revalidate):
     """The server command will launch a local server for development.
 
     Lektor's developemnt server will automatically build all files into
@@ -314,7 +321,7 @@ def server_cmd(ctx, host, port, output_path, verbosity, build_flags, browse):
                verbosity=verbosity, ui_lang=ctx.ui_lang,
                build_flags=build_flags,
                lektor_dev=os.environ.get('LEKTOR_DEV') == '1',
-               browse=browse)
+               browse=browse, stale_while_revalidate=stale_while_revalidate)
 
 
 @cli.command('project-info', short_help='Shows the info about a project.')
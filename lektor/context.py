@@ -1,10 +1,11 @@
+import shutil
+
 from jinja2 import Undefined
 from contextlib import contextmanager
 
 from werkzeug.local import LocalStack, LocalProxy
 
 from lektor.reporter import reporter
-from lektor.utils import make_relative_url
 
 
 _ctx_stack = LocalStack()
@@ -20,15 +21,34 @@ def url_to(*args, **kwargs):
 
 def get_asset_url(asset):
     """Calculates the asset URL relative to the current record."""
+    from lektor.assets import File, get_fingerprinted_name
     ctx = get_ctx()
     if ctx is None:
         raise RuntimeError('No context found')
     asset = site_proxy.get_asset(asset)
     if asset is None:
         return Undefined('Asset not found')
+    # The URL changes with the asset so the page needs to be rebuilt.
+    ctx.record_dependency(asset.source_filename)
+    if ctx.pad.db.config.fingerprint_assets and isinstance(asset, File):
+        # Only assets that are linked this way get a fingerprinted copy.
+        # Older copies are kept around until the build folder is pruned.
+        fingerprint = ctx.build_state.get_asset_fingerprint(asset)
+        source_filename = asset.source_filename
+
+        @ctx.sub_artifact(artifact_name=get_fingerprinted_name(
+            asset.artifact_name, fingerprint), sources=[source_filename])
+        def build_fingerprinted_asset(artifact):
+            with artifact.open('wb') as df:
+                with open(source_filename, 'rb') as sf:
+                    shutil.copyfileobj(sf, df)
+
+        return ctx.make_relative_url(
+            ctx.source.url_path,
+            get_fingerprinted_name(asset.url_path, fingerprint))
     info = ctx.build_state.get_file_info(asset.source_filename)
     return '%s?h=%s' % (
-        ctx.source.url_to('!' + asset.url_path),
+        ctx.make_relative_url(ctx.source.url_path, asset.url_path),
         info.checksum[:8],
     )
 
@@ -85,6 +105,7 @@ class Context(object):
 
         # Processing information
         self.referenced_dependencies = set()
+        self.tracked_records = set()
         self.sub_artifacts = []
 
         self.flow_block_render_stack = []
@@ -147,12 +168,19 @@ class Context(object):
         if self.source is None:
             raise RuntimeError('Can only generate paths to other pages if '
                                'the context has a source document set.')
-        rv = self.source.url_to(path, alt=alt, absolute=True)
+        rv = self.build_state.path_cache.resolve_url_target(
+            self.source, path, alt)
         if absolute:
             return rv
         elif external:
             return self.pad.make_absolute_url(rv)
-        return make_relative_url(self.base_url, rv)
+        return self.make_relative_url(self.base_url, rv)
+
+    def make_relative_url(self, base, target):
+        """Like :func:`lektor.utils.make_relative_url` but the results are
+        cached for the duration of the build.
+        """
+        return self.build_state.path_cache.make_relative_url(base, target)
 
     def sub_artifact(self, *args, **kwargs):
         """Decorator version of :func:`add_sub_artifact`."""
@@ -182,6 +210,11 @@ class Context(object):
         for coll in self._dependency_collectors:
             coll(filename)
 
+    @property
+    def is_gathering_dependencies(self):
+        """Indicates if dependencies are currently being gathered."""
+        return bool(self._dependency_collectors)
+
     @contextmanager
     def gather_dependencies(self, func):
         """For the duration of the `with` block the provided function will be
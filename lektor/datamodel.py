@@ -179,6 +179,55 @@ class Field(object):
         )
 
 
+class _LazyFieldValue(object):
+    """Holds the raw value of a field until it's deserialized."""
+    __slots__ = ('field', 'value', 'pad')
+
+    def __init__(self, field, value, pad=None):
+        self.field = field
+        self.value = value
+        self.pad = pad
+
+    def deserialize(self):
+        return self.field.deserialize_value(self.value, pad=self.pad)
+
+
+class RecordData(dict):
+    """The processed data of a record.  Values of fields added with
+    :meth:`set_lazy` stay in their raw form until they are looked up for
+    the first time.  The deserialized value then replaces the raw one.
+
+    If the record was loaded with only some of its fields, the values that
+    were skipped are marked with `Ellipsis`.  Looking up any of those loads
+    the remaining values from the source file.
+    """
+
+    def set_lazy(self, field, value, pad=None):
+        dict.__setitem__(self, field.name, _LazyFieldValue(field, value, pad))
+
+    def _load_skipped_values(self, pad):
+        raw_data = pad.db.load_raw_data(dict.__getitem__(self, '_path'),
+                                        alt=dict.__getitem__(self, '_alt'))
+        for value in self.itervalues():
+            if isinstance(value, _LazyFieldValue) and value.value is Ellipsis:
+                value.value = (raw_data or {}).get(value.field.name)
+
+    def __getitem__(self, name):
+        rv = dict.__getitem__(self, name)
+        if isinstance(rv, _LazyFieldValue):
+            if rv.value is Ellipsis:
+                self._load_skipped_values(rv.pad)
+            rv = rv.deserialize()
+            dict.__setitem__(self, name, rv)
+        return rv
+
+    def get(self, name, default=None):
+        try:
+            return self[name]
+        except KeyError:
+            return default
+
+
 def _iter_all_fields(obj):
     for name in sorted(x for x in obj.field_map if x[:1] == '_'):
         yield obj.field_map[name]
@@ -228,6 +277,10 @@ class DataModel(object):
         for key, (ty, opts) in system_fields.iteritems():
             self.field_map[key] = Field(env, name=key, type=ty, options=opts)
 
+        # The models this model depends on.  This is filled in by
+        # `load_datamodels` once all models are known.
+        self.dependent_models = None
+
         self._child_slug_tmpl = None
         self._child_replacements = None
         self._label_tmpls = {}
@@ -331,10 +384,16 @@ class DataModel(object):
         return self._child_replacements[1].evaluate(record.pad, this=record)
 
     def process_raw_data(self, raw_data, pad=None):
-        rv = {}
+        rv = RecordData()
         for field in self.field_map.itervalues():
             value = raw_data.get(field.name)
-            rv[field.name] = field.deserialize_value(value, pad=pad)
+            # System fields are needed to finish setting up the record so
+            # they are processed right away.  Everything else is only
+            # deserialized once the record is asked for it.
+            if field.name[:1] == '_':
+                rv[field.name] = field.deserialize_value(value, pad=pad)
+            else:
+                rv.set_lazy(field, value, pad=pad)
         rv['_model'] = self.id
         return rv
 
@@ -549,6 +608,29 @@ def iter_inis(path):
             raise
 
 
+def find_dependent_models(datamodel, datamodels):
+    """Finds all models that a model depends on by following parents as
+    well as the child and attachment models.  The model itself is not
+    included.
+    """
+    seen = set()
+    def deep_find(datamodel):
+        seen.add(datamodel)
+
+        if datamodel.parent is not None and datamodel.parent not in seen:
+            deep_find(datamodel.parent)
+
+        for related_dm_name in (datamodel.child_config.model,
+                                datamodel.attachment_config.model):
+            dm = datamodels.get(related_dm_name)
+            if dm is not None and dm not in seen:
+                deep_find(dm)
+
+    deep_find(datamodel)
+    seen.discard(datamodel)
+    return seen
+
+
 def load_datamodels(env):
     """Loads the datamodels for a specific environment."""
     path = os.path.join(env.root_path, 'models')
@@ -584,6 +666,9 @@ def load_datamodels(env):
 
     rv['none'] = DataModel(env, 'none', {'en': 'None'}, hidden=True)
 
+    for model in rv.itervalues():
+        model.dependent_models = frozenset(find_dependent_models(model, rv))
+
     return rv
 
 
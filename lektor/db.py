@@ -2,6 +2,7 @@ import os
 import errno
 import hashlib
 import operator
+import stat
 import posixpath
 
 from itertools import islice, chain
@@ -18,7 +19,7 @@ from lektor.utils import sort_normalize_string, cleanup_path, to_os_path, \
      fs_enc
 from lektor.sourceobj import SourceObject
 from lektor.context import get_ctx
-from lektor.datamodel import load_datamodels, load_flowblocks
+from lektor.datamodel import find_dependent_models, system_fields
 from lektor.imagetools import make_thumbnail, read_exif, get_image_info
 from lektor.assets import Directory
 from lektor.editor import make_editor_session
@@ -119,6 +120,16 @@ def _auto_wrap_expr(value):
     return _Literal(value)
 
 
+def _union_fields(*exprs):
+    rv = set()
+    for expr in exprs:
+        fields = expr.__referenced_fields__()
+        if fields is None:
+            return None
+        rv.update(fields)
+    return rv
+
+
 def save_eval(filter, record):
     try:
         return filter.__eval__(record)
@@ -131,6 +142,12 @@ class Expression(object):
     def __eval__(self, record):
         return record
 
+    def __referenced_fields__(self):
+        """Returns the set of record fields this expression looks at or
+        `None` if this is not known.
+        """
+        return None
+
     def __eq__(self, other):
         return _BinExpr(self, _auto_wrap_expr(other), operator.eq)
 
@@ -197,6 +214,9 @@ class _IsBoolExpr(Expression):
         return (not is_undefined(val) and
                 val not in (None, 0, False, '')) == self.__true
 
+    def __referenced_fields__(self):
+        return self.__expr.__referenced_fields__()
+
 
 class _Literal(Expression):
 
@@ -206,6 +226,9 @@ class _Literal(Expression):
     def __eval__(self, record):
         return self.__value
 
+    def __referenced_fields__(self):
+        return set()
+
 
 class _BinExpr(Expression):
 
@@ -220,6 +243,9 @@ class _BinExpr(Expression):
             self.__right.__eval__(record)
         )
 
+    def __referenced_fields__(self):
+        return _union_fields(self.__left, self.__right)
+
 
 class _ContainmentExpr(Expression):
 
@@ -234,6 +260,9 @@ class _ContainmentExpr(Expression):
             item = item['_id']
         return item in seq
 
+    def __referenced_fields__(self):
+        return _union_fields(self.__seq, self.__item)
+
 
 class _RecordQueryField(Expression):
 
@@ -246,6 +275,9 @@ class _RecordQueryField(Expression):
         except KeyError:
             return Undefined(obj=record, name=self.__field)
 
+    def __referenced_fields__(self):
+        return set([self.__field])
+
 
 class _RecordQueryProxy(object):
 
@@ -291,7 +323,7 @@ class Record(SourceObject):
         """Returns the alt of this source object."""
         return self['_alt']
 
-    @property
+    @cached_property
     def is_hidden(self):
         """Indicates if a record is hidden.  A record is considered hidden
         if the record itself is hidden or the parent is.
@@ -334,17 +366,21 @@ class Record(SourceObject):
     def record_label(self):
         return (self.get_record_label_i18n() or {}).get('en')
 
-    @property
-    def url_path(self):
-        """The target path where the record should end up."""
+    @cached_property
+    def _parent_slugs(self):
+        """The processed slugs of all parents of this record.  These are
+        cached per record so that the url paths of siblings can reuse the
+        ones of their (cached) parent.
+        """
+        parent = self.parent
+        if parent is None:
+            return ()
+        return parent._parent_slugs + (_process_slug(parent['_slug']),)
+
+    def _get_url_path(self):
         prefix, suffix = self.pad.db.config.get_alternative_url_span(
             self.alt)
-        bits = []
-        node = self
-        while node is not None:
-            bits.append(_process_slug(node['_slug'], node is self))
-            node = node.parent
-        bits.reverse()
+        bits = self._parent_slugs + (_process_slug(self['_slug'], True),)
 
         clean_path = '/'.join(bits).strip('/')
         if prefix:
@@ -355,6 +391,11 @@ class Record(SourceObject):
             clean_path += suffix
         return '/' + clean_path.strip('/')
 
+    @cached_property
+    def url_path(self):
+        """The target path where the record should end up."""
+        return self._get_url_path()
+
     @property
     def path(self):
         return self['_path']
@@ -426,9 +467,9 @@ class Page(Record):
             yield os.path.join(self.pad.db.to_fs_path(self['_path']),
                                'contents.lr')
 
-    @property
+    @cached_property
     def url_path(self):
-        rv = Record.url_path.__get__(self).rstrip('/')
+        rv = self._get_url_path().rstrip('/')
         last_part = rv.rsplit('/')[-1]
         if '.' not in last_part:
             rv += '/'
@@ -643,12 +684,26 @@ class Query(object):
             rv._pristine = False
         return rv
 
-    def _get(self, id, persist=True, page_num=Ellipsis):
+    def _get(self, id, persist=True, page_num=Ellipsis, fields=None):
         """Low level record access."""
         if page_num is Ellipsis:
             page_num = self._page_num
         return self.pad.get('%s/%s' % (self.path, id), persist=persist,
-                            alt=self.alt, page_num=page_num)
+                            alt=self.alt, page_num=page_num, fields=fields)
+
+    def _get_projected_fields(self):
+        """Returns the fields that are needed to filter and order the
+        records of this query or `None` if this cannot be determined.
+        """
+        rv = set(system_fields)
+        for filter in self._filters or ():
+            fields = filter.__referenced_fields__()
+            if fields is None:
+                return None
+            rv.update(fields)
+        for field in self.get_order_by() or ():
+            rv.add(field.lstrip('+-'))
+        return rv
 
     def _matches(self, record):
         if not self._include_hidden and record.is_hidden:
@@ -674,13 +729,17 @@ class Query(object):
         if ctx is not None:
             ctx.record_dependency(self.pad.db.to_fs_path(self.path))
 
+        # Records are only loaded with the fields needed for filtering and
+        # ordering.  The rest is read in once something else looks at it.
+        fields = self._get_projected_fields()
+
         for name, _, is_attachment in self.pad.db.iter_items(
                 self.path, alt=self.alt):
             if not ((is_attachment == self._include_attachments) or
                     (not is_attachment == self._include_pages)):
                 continue
 
-            record = self._get(name, persist=False)
+            record = self._get(name, persist=False, fields=fields)
             if self._matches(record):
                 yield record
 
@@ -786,7 +845,7 @@ class Query(object):
 
 class EmptyQuery(Query):
 
-    def _get(self, id, persist=True, page_num=Ellipsis):
+    def _get(self, id, persist=True, page_num=Ellipsis, fields=None):
         pass
 
     def _iterate(self):
@@ -860,6 +919,14 @@ def _iter_content_files(dir_path, alts):
         yield PRIMARY_ALT
 
 
+def _get_file_stamp(filename):
+    try:
+        st = os.stat(filename)
+    except OSError:
+        return None
+    return st.st_mtime, st.st_size
+
+
 def _iter_datamodel_choices(datamodel_name, path, is_attachment=False):
     yield datamodel_name
     if not is_attachment:
@@ -875,16 +942,25 @@ class Database(object):
         if config is None:
             config = env.load_config()
         self.config = config
-        self.datamodels = load_datamodels(env)
-        self.flowblocks = load_flowblocks(env)
+        self.datamodels, self.flowblocks = env.load_models()
+
+        # Maps ``(parent_path, is_attachment)`` to the implied model name
+        # and the stamps of the source files it was determined from.
+        self._implied_model_cache = {}
+
+        # Maps paths to the mtime of their folder and the sorted IDs of
+        # their children (with an attachment flag) for the tree.
+        self._child_ids_cache = {}
 
     def to_fs_path(self, path):
         """Convenience function to convert a path into an file system path."""
         return os.path.join(self.env.root_path, 'content', to_os_path(path))
 
-    def load_raw_data(self, path, alt=PRIMARY_ALT, cls=None):
+    def load_raw_data(self, path, alt=PRIMARY_ALT, cls=None, fields=None):
         """Internal helper that loads the raw record data.  This performs
-        very little data processing on the data.
+        very little data processing on the data.  If `fields` is given,
+        only the values of those keys are read and all other keys that
+        exist in the file are set to `Ellipsis`.
         """
         path = cleanup_path(path)
         if cls is None:
@@ -897,8 +973,12 @@ class Database(object):
         for fs_path, source_alt, is_attachment in choiceiter:
             try:
                 with open(fs_path, 'rb') as f:
-                    for key, lines in metaformat.tokenize(f, encoding='utf-8'):
-                        rv[key] = u''.join(lines)
+                    for key, lines in metaformat.tokenize(
+                            f, interesting_keys=fields, encoding='utf-8'):
+                        if lines is None:
+                            rv[key] = Ellipsis
+                        else:
+                            rv[key] = u''.join(lines)
             except IOError as e:
                 if e.errno not in (errno.ENOTDIR, errno.ENOENT):
                     raise
@@ -989,56 +1069,75 @@ class Database(object):
                                           datamodel=datamodel)
 
     def iter_dependent_models(self, datamodel):
-        seen = set()
-        def deep_find(datamodel):
-            seen.add(datamodel)
-
-            if datamodel.parent is not None and datamodel.parent not in seen:
-                deep_find(datamodel.parent)
-
-            for related_dm_name in (datamodel.child_config.model,
-                                    datamodel.attachment_config.model):
-                dm = self.datamodels.get(related_dm_name)
-                if dm is not None and dm not in seen:
-                    deep_find(dm)
-
-        deep_find(datamodel)
-        seen.discard(datamodel)
-        return iter(seen)
+        if datamodel.dependent_models is not None:
+            return iter(datamodel.dependent_models)
+        return iter(find_dependent_models(datamodel, self.datamodels))
 
     def get_implied_datamodel(self, path, is_attachment=False, pad=None,
                               datamodel=None):
         """Looks up a datamodel based on the information about the parent
         of a model.
         """
-        dm_name = datamodel
+        return self._resolve_implied_datamodel(path, is_attachment,
+                                               datamodel)[0]
+
+    def _resolve_implied_datamodel(self, path, is_attachment, dm_name):
+        dependencies = ()
 
-        # Only look for a datamodel if there was not defined.
+        # Only look for a datamodel if there was not defined.  If we hit
+        # the root, and there is no model defined we need to make sure we
+        # do not recurse onto ourselves.
         if dm_name is None:
             parent = posixpath.dirname(path)
-            dm_name = None
-
-            # If we hit the root, and there is no model defined we need
-            # to make sure we do not recurse onto ourselves.
             if parent != path:
-                if pad is None:
-                    pad = self.new_pad()
-                parent_obj = pad.get(parent)
-                if parent_obj is not None:
-                    if is_attachment:
-                        dm_name = parent_obj.datamodel.attachment_config.model
-                    else:
-                        dm_name = parent_obj.datamodel.child_config.model
+                dm_name, dependencies = self._get_implied_model_name(
+                    parent, is_attachment)
 
         for dm_name in _iter_datamodel_choices(dm_name, path, is_attachment):
             # If that datamodel exists, let's roll with it.
             datamodel = self.datamodels.get(dm_name)
             if datamodel is not None:
-                return datamodel
+                return datamodel, dependencies
 
         raise AssertionError("Did not find an appropriate datamodel.  "
                              "That should never happen.")
 
+    def _get_implied_model_name(self, parent, is_attachment):
+        """Returns the name of the model that the record at `parent`
+        configures for its children or attachments.  Only the `_model`
+        keys of the parent and its ancestors are read for this and the
+        result is cached until one of the source files changes.
+        """
+        key = (parent, is_attachment)
+        rv = self._implied_model_cache.get(key)
+        if rv is None or any(_get_file_stamp(fn) != stamp
+                             for fn, stamp in rv[1]):
+            fn_base = self.to_fs_path(parent)
+            dependencies = [(fn, _get_file_stamp(fn)) for fn, _, _ in
+                            _iter_filename_choices(fn_base, [PRIMARY_ALT],
+                                                   self.config)]
+            dm_name = None
+            raw_data = self.load_raw_data(parent, fields=('_model',))
+            if raw_data is not None:
+                parent_model, parent_dependencies = \
+                    self._resolve_implied_datamodel(
+                        parent, bool(raw_data.get('_attachment_for')),
+                        (raw_data.get('_model') or '').strip() or None)
+                dependencies.extend(parent_dependencies)
+                if is_attachment:
+                    dm_name = parent_model.attachment_config.model
+                else:
+                    dm_name = parent_model.child_config.model
+            rv = self._implied_model_cache[key] = \
+                dm_name, tuple(dependencies)
+
+        ctx = get_ctx()
+        if ctx is not None:
+            for filename, stamp in rv[1]:
+                if stamp is not None:
+                    ctx.record_dependency(filename)
+        return rv
+
     def get_attachment_type(self, path):
         """Gets the attachment type for a path."""
         return self.config['ATTACHMENT_TYPES'].get(
@@ -1047,6 +1146,13 @@ class Database(object):
     def track_record_dependency(self, record):
         ctx = get_ctx()
         if ctx is not None:
+            # If the dependencies of this record were already recorded
+            # there is nothing left to do unless someone gathers them.
+            key = (record.path, record.alt)
+            if key in ctx.tracked_records and \
+               not ctx.is_gathering_dependencies:
+                return record
+            ctx.tracked_records.add(key)
             for filename in record.iter_source_filenames():
                 ctx.record_dependency(filename)
             if record.datamodel.filename:
@@ -1151,12 +1257,17 @@ class Pad(object):
         return url_join(base_url.rstrip('/') + '/', url.lstrip('/'))
 
     def resolve_url_path(self, url_path, include_invisible=False,
-                         include_assets=True, alt_fallback=True):
+                         include_assets=True, alt_fallback=True,
+                         build_state=None):
         """Given a URL path this will find the correct record which also
         might be an attachment.  If a record cannot be found or is unexposed
         the return value will be `None`.
+
+        If a `build_state` is provided, the URL routes it remembers are
+        consulted first so that the tree does not have to be walked.
         """
         clean_path = cleanup_path(url_path).strip('/')
+        route_key = clean_path
 
         # Split off the alt and if no alt was found, point it to the
         # primary alternative.  If the clean path comes back as `None`
@@ -1169,21 +1280,69 @@ class Pad(object):
                     alt = self.db.config.primary_alternative or PRIMARY_ALT
                 else:
                     alt = PRIMARY_ALT
-            node = self.get_root(alt=alt)
-            if node is None:
-                raise RuntimeError('Tree root could not be found.')
 
             pieces = clean_path.split('/')
             if pieces == ['']:
                 pieces = []
 
-            rv = node.resolve_url_path(pieces)
+            rv = None
+            if build_state is not None:
+                rv = self._resolve_url_route(route_key, alt, build_state,
+                                             include_invisible)
+
+            if rv is None:
+                node = self.get_root(alt=alt)
+                if node is None:
+                    raise RuntimeError('Tree root could not be found.')
+                rv = node.resolve_url_path(pieces)
+                if build_state is not None and isinstance(rv, Record) and \
+                   rv.url_path.strip('/') == route_key:
+                    build_state.write_url_routes([(
+                        rv.url_path, rv.path, rv.alt, rv.page_num)])
+
             if rv is not None and (include_invisible or rv.is_visible):
                 return rv
 
         if include_assets:
             return self.asset_root.resolve_url_path(pieces)
 
+    def _resolve_url_route(self, route_key, alt, build_state,
+                           include_invisible=False):
+        route = build_state.get_url_route(route_key)
+        if route is None:
+            return None
+        path, route_alt, page_num = route
+        # Attachments are recorded with the primary alt.
+        if route_alt not in (alt, PRIMARY_ALT):
+            return None
+        node = self.get(path, alt=alt, page_num=page_num)
+        if node is None:
+            return None
+
+        # The route might be outdated, so make sure the record still has
+        # the URL that was requested and is visible.
+        rv = node.resolve_url_path([])
+        if rv is None or rv.url_path.strip('/') != route_key:
+            return None
+        if not include_invisible and not rv.is_visible:
+            return None
+
+        # Another record might have taken over the URL since, for instance
+        # a page that shadows an attachment with the same slug.  This only
+        # needs to be checked among the siblings.
+        parent = rv.parent
+        if parent is not None:
+            prefix = parent.url_path.strip('/')
+            if prefix:
+                prefix += '/'
+            if not route_key.startswith(prefix):
+                return None
+            other = parent.resolve_url_path(
+                route_key[len(prefix):].split('/'))
+            if other != rv or other.page_num != rv.page_num:
+                return None
+        return rv
+
     def get_root(self, alt=PRIMARY_ALT):
         """The root page of the database."""
         return self.get('/', alt=alt, persist=True)
@@ -1210,15 +1369,19 @@ class Pad(object):
         rv.append(self.asset_root)
         return rv
 
-    def get(self, path, alt=PRIMARY_ALT, page_num=None, persist=True):
-        """Loads a record by path."""
+    def get(self, path, alt=PRIMARY_ALT, page_num=None, persist=True,
+            fields=None):
+        """Loads a record by path.  If `fields` is provided and the record
+        is not cached yet, only those fields are read from the source file
+        at first.
+        """
         rv = self.cache.get(path, alt, page_num)
         if rv is not Ellipsis:
             if rv is not None:
                 self.db.track_record_dependency(rv)
             return rv
 
-        raw_data = self.db.load_raw_data(path, alt=alt)
+        raw_data = self.db.load_raw_data(path, alt=alt, fields=fields)
         if raw_data is None:
             self.cache.remember_as_missing(path, alt, page_num)
             return
@@ -1306,6 +1469,15 @@ class TreeItem(object):
         return self.tree.iter_children(self.path, include_attachments,
                                        include_pages)
 
+    def get_child_ids(self, include_attachments=True, include_pages=True):
+        """Returns a sorted list of the IDs of all children without
+        loading them.
+        """
+        if not self.exists:
+            return []
+        return self.tree._get_child_ids(self.path, include_attachments,
+                                        include_pages)
+
     def get_children(self, offset=0, limit=None, include_attachments=True,
                      include_pages=True):
         """Returns a list of all children."""
@@ -1333,6 +1505,22 @@ class Alt(object):
         return '<Alt %r%s>' % (self.id, self.exists and '*' or '')
 
 
+def _get_folder_stamp(fs_path):
+    """Returns a stamp that changes when files are added to or removed
+    from a folder or any of its subfolders.  Subfolders need to be looked
+    at as adding a contents file to a page does not touch its parent.
+    """
+    try:
+        rv = [os.stat(fs_path).st_mtime]
+        for filename in os.listdir(fs_path):
+            st = os.stat(os.path.join(fs_path, filename))
+            if stat.S_ISDIR(st.st_mode):
+                rv.append((filename, st.st_mtime))
+    except OSError:
+        return None
+    return rv
+
+
 class Tree(object):
     """Special object that can be used to get a broader insight into the
     database in a way that is not bound to the alt system directly.
@@ -1405,14 +1593,28 @@ class Tree(object):
 
     def _get_child_ids(self, path=None, include_attachments=True,
                        include_pages=True):
-        """Returns a sorted list of just the IDs of children below a path."""
+        """Returns a sorted list of just the IDs of children below a path.
+        The listing is cached on the database for as long as neither the
+        folder of the path nor any of its subfolders are modified.
+        """
         path = '/' + (path or '').strip('/')
-        names = set()
-        for name, _, is_attachment in self.pad.db.iter_items(path, alt=None):
-            if (is_attachment and include_attachments) or \
-               (not is_attachment and include_pages):
-                names.add(name)
-        return sorted(names, key=lambda x: x.lower())
+        db = self.pad.db
+        stamp = _get_folder_stamp(db.to_fs_path(path))
+
+        cached = db._child_ids_cache.get(path)
+        if cached is not None and stamp is not None and cached[0] == stamp:
+            items = cached[1]
+        else:
+            items = {}
+            for name, _, is_attachment in db.iter_items(path, alt=None):
+                items[name] = is_attachment
+            items = sorted(items.items(), key=lambda x: x[0].lower())
+            if stamp is not None:
+                db._child_ids_cache[path] = (stamp, items)
+
+        return [name for name, is_attachment in items
+                if (is_attachment and include_attachments) or
+                (not is_attachment and include_pages)]
 
     def iter_children(self, path=None, include_attachments=True,
                       include_pages=True):
@@ -1497,6 +1699,22 @@ class RecordCache(object):
             return rv
         return Ellipsis
 
+    def forget(self, path, children=False):
+        """Forgets the cached records of a path in all alts and for all
+        pages.  If `children` is set, all records below the path are
+        forgotten as well.
+        """
+        path = path.strip('/')
+        prefix = path and path + '/' or ''
+        for section in self.persistent, self.ephemeral:
+            for cache_key in list(section.keys()):
+                if cache_key[0] == path or \
+                   (children and cache_key[0].startswith(prefix)):
+                    try:
+                        del section[cache_key]
+                    except KeyError:
+                        pass
+
     def remember_as_missing(self, path, alt=PRIMARY_ALT, page_num=None):
         cache_key = self._get_cache_key(path, alt, page_num)
         self.persistent.pop(cache_key, None)
@@ -24,7 +24,8 @@ class SilentWSGIRequestHandler(WSGIRequestHandler):
 
 class BackgroundBuilder(threading.Thread):
 
-    def __init__(self, env, output_path, verbosity=0, build_flags=None):
+    def __init__(self, env, output_path, verbosity=0, build_flags=None,
+                 build_callback=None):
         threading.Thread.__init__(self)
         watcher = Watcher(env, output_path)
         watcher.observer.start()
@@ -34,12 +35,15 @@ class BackgroundBuilder(threading.Thread):
         self.verbosity = verbosity
         self.last_build = time.time()
         self.build_flags = build_flags
+        self.build_callback = build_callback
 
     def build(self, update_source_info_first=False):
         try:
             db = Database(self.env)
             builder = Builder(db.new_pad(), self.output_path,
                               build_flags=self.build_flags)
+            if self.build_callback is not None:
+                builder.build_callbacks.append(self.build_callback)
             if update_source_info_first:
                 builder.update_all_source_infos()
             builder.build_all()
@@ -49,10 +53,18 @@ class BackgroundBuilder(threading.Thread):
         else:
             self.last_build = time.time()
 
+    def is_model_path(self, path):
+        """Checks if a path belongs to the model or flowblock files."""
+        folder = os.path.dirname(os.path.abspath(path))
+        return folder in (os.path.join(self.env.root_path, 'models'),
+                          os.path.join(self.env.root_path, 'flowblocks'))
+
     def run(self):
         with CliReporter(self.env, verbosity=self.verbosity):
             self.build(update_source_info_first=True)
-            for ts, _, _ in self.watcher:
+            for ts, _, path in self.watcher:
+                if self.is_model_path(path):
+                    self.env.invalidate_models()
                 if self.last_build is None or ts > self.last_build:
                     self.build()
 
@@ -94,7 +106,8 @@ def browse_to_address(addr):
 
 
 def run_server(bindaddr, env, output_path, verbosity=0, lektor_dev=False,
-               ui_lang='en', browse=False, build_flags=None):
+               ui_lang='en', browse=False, build_flags=None,
+               stale_while_revalidate=False):
     """This runs a server but also spawns a background process.  It's
     not safe to call this more than once per python process!
     """
@@ -102,17 +115,25 @@ def run_server(bindaddr, env, output_path, verbosity=0, lektor_dev=False,
     in_main_process = not lektor_dev or wz_as_main
     build_flags = process_build_flags(build_flags)
 
+    app = WebAdmin(env, output_path=output_path, verbosity=verbosity,
+                   debug=lektor_dev, ui_lang=ui_lang,
+                   build_flags=build_flags,
+                   stale_while_revalidate=stale_while_revalidate)
+
     if in_main_process:
-        background_builder = BackgroundBuilder(env, output_path, verbosity,
-                                               build_flags)
+        # The background builder tells the admin about rebuilt artifacts
+        # so that open previews can reload.
+        background_builder = BackgroundBuilder(
+            env, output_path, verbosity, build_flags,
+            build_callback=app.lektor_info.notify_build)
         background_builder.setDaemon(True)
         background_builder.start()
         env.plugin_controller.emit('server-spawn', bindaddr=bindaddr,
                                    build_flags=build_flags)
 
-    app = WebAdmin(env, output_path=output_path, verbosity=verbosity,
-                   debug=lektor_dev, ui_lang=ui_lang,
-                   build_flags=build_flags)
+        # Keeps the warm pads and known artifacts of the admin in sync
+        # with the file system.
+        app.lektor_info.watch()
 
     dt = None
     if lektor_dev and not wz_as_main:
@@ -212,6 +212,29 @@ class Config(object):
         """The locale of this project."""
         return self.values['PROJECT']['locale']
 
+    @property
+    def fingerprint_assets(self):
+        """Indicates if assets are built with content hashed filenames."""
+        return bool_from_string(
+            self.values['PROJECT'].get('fingerprint_assets'), False)
+
+    @property
+    def fingerprint_retention(self):
+        """The number of older versions of fingerprinted assets that are
+        kept when the build folder is pruned.
+        """
+        try:
+            return max(int(self.values['PROJECT'].get(
+                'fingerprint_retention') or 1), 0)
+        except ValueError:
+            return 1
+
+    @property
+    def precompress_formats(self):
+        """The formats output files are precompressed in."""
+        value = self.values['PROJECT'].get('precompress') or ''
+        return [x.strip() for x in value.split(',') if x.strip()]
+
     def get_servers(self, public=False):
         """Returns a list of servers."""
         rv = {}
@@ -388,6 +411,10 @@ class Environment(object):
         self.custom_url_resolvers = []
         self.custom_generators = []
 
+        # The datamodels and flowblocks are shared between all databases
+        # of this environment.  See :meth:`load_models`.
+        self._model_cache = None
+
         if load_plugins:
             self.load_plugins()
 
@@ -410,6 +437,48 @@ class Environment(object):
         """Loads the current config."""
         return Config(self.project.project_file)
 
+    def get_model_stamps(self):
+        """Returns a tuple that changes whenever one of the model or
+        flowblock files of the project is added, removed or modified.
+        """
+        rv = []
+        for folder in 'models', 'flowblocks':
+            path = os.path.join(self.root_path, folder)
+            try:
+                filenames = os.listdir(path)
+            except OSError:
+                continue
+            for filename in filenames:
+                if not filename.endswith('.ini'):
+                    continue
+                try:
+                    st = os.stat(os.path.join(path, filename))
+                except OSError:
+                    continue
+                rv.append((folder, filename, st.st_mtime, st.st_size))
+        rv.sort()
+        return tuple(rv)
+
+    def load_models(self):
+        """Returns the datamodels and flowblocks of the project as tuple.
+        These are cached on the environment and only loaded again if one
+        of the model or flowblock files changed or the models were
+        explicitly invalidated with :meth:`invalidate_models`.
+        """
+        from lektor.datamodel import load_datamodels, load_flowblocks
+        stamps = self.get_model_stamps()
+        rv = self._model_cache
+        if rv is None or rv[0] != stamps:
+            rv = (stamps, load_datamodels(self), load_flowblocks(self))
+            self._model_cache = rv
+        return rv[1], rv[2]
+
+    def invalidate_models(self):
+        """Forgets the cached models so that the next database loads them
+        again.
+        """
+        self._model_cache = None
+
     def new_pad(self):
         """Convenience function to create a database and pad."""
         from lektor.db import Database
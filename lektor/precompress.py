@@ -0,0 +1,170 @@
+import os
+import gzip
+import tempfile
+import threading
+import mimetypes
+from io import BytesIO
+from contextlib import contextmanager
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+
+from werkzeug.posixemulation import rename
+
+
+#: Mimetypes outside of ``text/*`` that are worth compressing.
+COMPRESSIBLE_MIMETYPES = set([
+    'application/javascript',
+    'application/x-javascript',
+    'application/json',
+    'application/xml',
+    'application/rss+xml',
+    'application/atom+xml',
+    'application/xhtml+xml',
+    'application/vnd.ms-fontobject',
+    'font/ttf',
+    'font/otf',
+    'application/x-font-ttf',
+    'image/svg+xml',
+    'image/x-icon',
+    'image/vnd.microsoft.icon',
+])
+
+
+def is_compressible(filename):
+    """Checks if a file is worth compressing based on its mimetype."""
+    mimetype = mimetypes.guess_type(filename)[0]
+    if mimetype is None:
+        return False
+    return mimetype.startswith('text/') or mimetype in COMPRESSIBLE_MIMETYPES
+
+
+def compress_gzip(data):
+    f = BytesIO()
+    # No filename and a fixed mtime keep the output reproducible.
+    with gzip.GzipFile(filename='', mode='wb', fileobj=f, mtime=0,
+                       compresslevel=9) as gz:
+        gz.write(data)
+    return f.getvalue()
+
+
+def compress_brotli(data):
+    import brotli
+    return brotli.compress(data)
+
+
+#: Maps the supported formats to their file extension and compressor.
+precompress_formats = {
+    'gzip': ('.gz', compress_gzip),
+    'brotli': ('.br', compress_brotli),
+}
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPool(cpu_count())
+        return _pool
+
+
+class Precompressor(object):
+    """Writes compressed siblings next to changed output files so that
+    web servers can serve them directly (for instance nginx with
+    ``gzip_static`` and ``brotli_static``).  Compression happens on a
+    thread pool that is shared by all builders while the build goes on.
+    """
+
+    def __init__(self, builder, formats):
+        self.builder = builder
+        self.formats = []
+        for name in formats:
+            format = precompress_formats.get(name)
+            if format is None:
+                raise RuntimeError('Unknown precompression format "%s"'
+                                   % name)
+            if name == 'brotli':
+                try:
+                    __import__('brotli')
+                except ImportError:
+                    raise RuntimeError('Precompressing with brotli requires '
+                                       'the brotli package.')
+            self.formats.append(format)
+        self._pending = []
+        self._batches = 0
+
+    def get_sibling_names(self, artifact_name):
+        """Returns the artifact names of the compressed siblings."""
+        return [artifact_name + ext for ext, func in self.formats]
+
+    def get_unused_extensions(self):
+        """Returns the extensions of the formats that are not configured.
+        Siblings with these extensions are left over from an earlier
+        configuration.
+        """
+        return sorted(ext for ext, func in precompress_formats.itervalues()
+                      if (ext, func) not in self.formats)
+
+    @contextmanager
+    def batch(self):
+        """Within a batch :meth:`flush` does not wait, the compressions
+        are waited for once the batch ends.
+        """
+        self._batches += 1
+        try:
+            yield
+        finally:
+            self._batches -= 1
+        if not self._batches:
+            self.wait()
+
+    def submit(self, artifact_name, filename, changed=True):
+        """Schedules compression for an artifact that was just committed.
+        Unless the output changed this only happens if siblings are
+        missing.
+        """
+        if not self.formats or not is_compressible(filename):
+            return
+        if not changed and all(os.path.isfile(filename + ext)
+                               for ext, func in self.formats):
+            return
+        self._pending.append(_get_pool().apply_async(
+            self._compress, (artifact_name, filename)))
+
+    def flush(self):
+        """Waits for the scheduled compressions unless a batch is in
+        progress.
+        """
+        if not self._batches:
+            self.wait()
+
+    def wait(self):
+        """Waits for all scheduled compressions to finish."""
+        pending = self._pending
+        self._pending = []
+        for result in pending:
+            result.get()
+
+    def _compress(self, artifact_name, filename):
+        with open(filename, 'rb') as f:
+            data = f.read()
+        for ext, func in self.formats:
+            fd, tmp_filename = tempfile.mkstemp(
+                dir=os.path.dirname(filename), prefix='.__trans')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(func(data))
+                os.chmod(tmp_filename, 0644)
+                rename(tmp_filename, filename + ext)
+            except:
+                try:
+                    os.remove(tmp_filename)
+                except OSError:
+                    pass
+                raise
+        with self.builder.new_build_state() as build_state:
+            build_state.register_sibling_artifacts(
+                artifact_name, self.get_sibling_names(artifact_name))
@@ -86,6 +86,11 @@ class Project(object):
         return os.path.join(click.get_app_dir('Lektor'), 'build-cache',
                             self.id)
 
+    def get_deploy_cache_path(self):
+        """The path where publishers keep state between deploys."""
+        return os.path.join(click.get_app_dir('Lektor'), 'deploy-cache',
+                            self.id)
+
     def get_package_cache_path(self):
         """The path where plugin packages are stored."""
         h = hashlib.md5()
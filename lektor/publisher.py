@@ -1,17 +1,21 @@
 import os
-import errno
+import re
 import select
 import shutil
 import hashlib
 import tempfile
+import threading
 import posixpath
 import subprocess
+from Queue import Queue, Empty
 from contextlib import contextmanager
 from cStringIO import StringIO
 
 from werkzeug import urls
 
-from lektor.utils import portable_popen, locate_executable
+from lektor.builder import Builder, FileInfo
+from lektor.utils import portable_popen, locate_executable, secure_url, \
+     prune_file_and_folder
 
 
 class PublishError(Exception):
@@ -24,7 +28,7 @@ class Command(object):
         environ = dict(os.environ)
         if env:
             environ.update(env)
-        kwargs = {'cwd': cwd, 'env': env}
+        kwargs = {'cwd': cwd, 'env': environ}
         if capture:
             kwargs['stdout'] = subprocess.PIPE
             kwargs['stderr'] = subprocess.PIPE
@@ -73,6 +77,25 @@ class Publisher(object):
     def publish(self, target_url, credentials=None):
         raise NotImplementedError()
 
+    def get_server_key(self, target_url):
+        """Returns the key under which deploys to a target are
+        remembered.
+        """
+        return secure_url(target_url.to_url())
+
+    @contextmanager
+    def open_build_state(self):
+        """Opens the build state of the output folder.  If the folder was
+        not built by Lektor `None` is provided instead.
+        """
+        if not os.path.isfile(os.path.join(self.output_path, '.lektor',
+                                           'buildstate')):
+            yield None
+            return
+        builder = Builder(self.env.new_pad(), self.output_path)
+        with builder.new_build_state() as build_state:
+            yield build_state
+
 
 class ExternalPublisher(Publisher):
 
@@ -86,14 +109,45 @@ class ExternalPublisher(Publisher):
                 yield line
 
 
+_rsync_version_re = re.compile(r'\bversion\s+(\d+)\.(\d+)')
+
+
 class RsyncPublisher(ExternalPublisher):
 
-    def get_command(self, target_url, credentials=None):
+    def get_rsync_version(self):
+        """Returns the version of the local rsync as tuple or `None` if
+        it cannot be determined.
+        """
+        try:
+            c = portable_popen(['rsync', '--version'],
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE)
+            output = c.communicate()[0]
+        except (OSError, RuntimeError):
+            return None
+        match = _rsync_version_re.search(output)
+        if match is not None:
+            return int(match.group(1)), int(match.group(2))
+
+    def supports_delta(self):
+        """Deleting files that are missing from the transferred list
+        requires rsync 3.1 or later.
+        """
+        version = self.get_rsync_version()
+        return version is not None and version >= (3, 1)
+
+    def get_command(self, target_url, credentials=None, files_from=None):
         credentials = credentials or {}
         argline = ['rsync', '-rclzv', '--exclude=.lektor']
         target = []
         env = {}
 
+        # Only the listed files are transferred, files in the list that
+        # no longer exist locally are deleted on the server.
+        if files_from is not None:
+            argline.append('--files-from=' + files_from)
+            argline.append('--delete-missing-args')
+
         if target_url.port is not None:
             argline.append('-e')
             argline.append('ssh -p ' + str(target_url.port))
@@ -113,17 +167,63 @@ class RsyncPublisher(ExternalPublisher):
         argline.append(''.join(target))
         return Command(argline, env=env)
 
+    def publish(self, target_url, credentials=None):
+        with self.open_build_state() as build_state:
+            if build_state is None:
+                for line in ExternalPublisher.publish(self, target_url,
+                                                      credentials):
+                    yield line
+                return
+
+            # The build state remembers what was last published to the
+            # server so that only the delta needs to be transferred.  For
+            # the first deploy everything is synced.
+            server = self.get_server_key(target_url)
+            build_state.update_artifact_checksums()
+            delta = build_state.get_publish_delta(server)
+            if not build_state.has_published_manifest(server):
+                files_from = None
+            elif delta and not self.supports_delta():
+                yield 'rsync is older than 3.1, syncing everything.'
+                files_from = None
+            elif not delta:
+                yield 'Nothing to publish.'
+                return
+            else:
+                fd, files_from = tempfile.mkstemp(prefix='.lektor-rsync')
+                with os.fdopen(fd, 'wb') as f:
+                    for artifact_name, checksum in delta:
+                        f.write(artifact_name.encode('utf-8') + '\n')
+
+            try:
+                client = self.get_command(target_url, credentials,
+                                          files_from)
+                with client:
+                    for line in client:
+                        yield line
+                if client.wait() != 0:
+                    raise PublishError('rsync failed with exit code %d.'
+                                       % client.wait())
+                build_state.record_published_artifacts(server, delta)
+            finally:
+                if files_from is not None:
+                    os.remove(files_from)
+
 
 class FtpConnection(object):
 
-    def __init__(self, url, credentials=None):
+    def __init__(self, url, credentials=None, known_folders=None):
         credentials = credentials or {}
         self.con = self.make_connection()
         self.url = url
         self.username = credentials.get('username') or url.username
         self.password = credentials.get('password') or url.password
         self.log_buffer = []
-        self._known_folders = set()
+        # Connections of a parallel upload share the folders they know
+        # to exist so that every folder is only created once.
+        if known_folders is None:
+            known_folders = set()
+        self._known_folders = known_folders
 
     def make_connection(self):
         from ftplib import FTP
@@ -172,6 +272,12 @@ class FtpConnection(object):
         log.append('000 Connected!')
         return True
 
+    def close(self):
+        try:
+            self.con.quit()
+        except Exception:
+            self.con.close()
+
     def mkdir(self, path, recursive=True):
         if isinstance(path, unicode):
             path = path.encode('utf-8')
@@ -185,7 +291,7 @@ class FtpConnection(object):
         except Exception as e:
             msg = str(e)
             if msg[:4] != '550 ':
-                self.log_buffer.append(e)
+                self.log_buffer.append(str(e))
                 return
         self._known_folders.add(path)
 
@@ -212,7 +318,7 @@ class FtpConnection(object):
         except Exception as e:
             msg = str(e)
             if msg[:4] != '550 ':
-                self.log_buffer.append(e)
+                self.log_buffer.append(str(e))
             return None
         if getvalue:
             return out.getvalue()
@@ -294,10 +400,21 @@ class FtpPublisher(Publisher):
                 rv[artifact_name] = items[1]
         return rv, duplicates
 
+    def get_recorded_checksums(self):
+        """Returns the output checksums that the builder recorded in the
+        build state of the output folder.
+        """
+        with self.open_build_state() as build_state:
+            if build_state is None:
+                return {}
+            return build_state.get_artifact_checksums()
+
     def iter_artifacts(self):
         """Iterates over all artifacts in the build folder and yields the
-        artifacts.
+        artifacts.  The checksums recorded by the builder are used if the
+        file did not change since, otherwise the file is hashed.
         """
+        recorded_checksums = self.get_recorded_checksums()
         for dirpath, dirnames, filenames in os.walk(self.output_path):
             dirnames[:] = [x for x in dirnames
                            if not self.env.is_ignored_artifact(x)]
@@ -309,35 +426,113 @@ class FtpPublisher(Publisher):
                     .lstrip(os.path.sep)
                 if os.path.altsep:
                     local_path = local_path.lstrip(os.path.altsep)
-                h = hashlib.sha1()
-                try:
-                    with open(full_path, 'rb') as f:
-                        item = f.read(4096)
-                        if not item:
-                            break
-                        h.update(item)
-                except IOError as e:
-                    if e.errno != errno.ENOENT:
-                        raise
-                yield (
-                    local_path.replace(os.path.sep, '/'),
-                    full_path,
-                    h.hexdigest(),
-                )
+                artifact_name = local_path.replace(os.path.sep, '/')
+                info = FileInfo(self.env, full_path)
+                recorded = recorded_checksums.get(artifact_name)
+                if recorded is not None and \
+                   recorded[:2] == (info.mtime, info.size):
+                    checksum = recorded[2]
+                else:
+                    checksum = info.checksum
+                yield artifact_name, full_path, checksum
 
     def get_temp_filename(self, filename):
         dirname, basename = posixpath.split(filename)
         return posixpath.join(dirname, '.' + basename + '.tmp')
 
-    def upload_artifact(self, con, artifact_name, source_file, checksum):
+    def get_connection_count(self, target_url):
+        """Returns the number of connections used for uploading which is
+        configured with the `connections` option of the target URL.
+        """
+        value = target_url.decode_query().get('connections')
+        try:
+            return max(int(value or 1), 1)
+        except ValueError:
+            raise PublishError('Invalid number of connections: %s' % value)
+
+    def upload_artifact(self, con, artifact_name, source_file, checksum,
+                        update_listing=True):
         with open(source_file, 'rb') as source:
             tmp_dst = self.get_temp_filename(artifact_name)
             con.log_buffer.append('000 Updating %s' % artifact_name)
-            con.upload_file(tmp_dst, source, mkdir=True)
+            if not con.upload_file(tmp_dst, source, mkdir=True):
+                return False
             con.rename_file(tmp_dst, artifact_name)
-            con.append('.lektor/listing', '%s|%s\n' % (
-                artifact_name.encode('utf-8'), checksum
-            ))
+            if update_listing:
+                con.append('.lektor/listing', '%s|%s\n' % (
+                    artifact_name.encode('utf-8'), checksum
+                ))
+        return True
+
+    def upload_artifacts_parallel(self, con, target_url, credentials,
+                                  artifacts, connections, failed):
+        """Uploads the given ``(artifact_name, filename, checksum)`` tuples
+        over a pool of connections and yields their log.  The listing is
+        not updated, this has to happen afterwards.  The names of the
+        artifacts that could not be uploaded are added to `failed`.
+        """
+        tasks = Queue()
+        for artifact in artifacts:
+            tasks.put(artifact)
+        events = Queue()
+
+        def worker():
+            worker_con = self.connection_class(
+                target_url, credentials, known_folders=con._known_folders)
+            connected = False
+            try:
+                connected = worker_con.connect()
+                while connected:
+                    try:
+                        artifact_name, filename, checksum = tasks.get_nowait()
+                    except Empty:
+                        break
+                    try:
+                        uploaded = self.upload_artifact(
+                            worker_con, artifact_name, filename, checksum,
+                            update_listing=False)
+                    except Exception as e:
+                        # The connection is in an unknown state, leave the
+                        # remaining artifacts to the other connections.
+                        failed.add(artifact_name)
+                        worker_con.log_buffer.append(
+                            '000 Upload of %s failed: %s' % (artifact_name, e))
+                        break
+                    if not uploaded:
+                        failed.add(artifact_name)
+                    events.put(list(worker_con.drain_log()))
+            except Exception as e:
+                worker_con.log_buffer.append('000 Upload failed: %s' % e)
+            finally:
+                if connected:
+                    try:
+                        worker_con.close()
+                    except Exception:
+                        pass
+                events.put(list(worker_con.drain_log()))
+                events.put(None)
+
+        workers = min(connections, len(artifacts))
+        for _ in xrange(workers):
+            t = threading.Thread(target=worker)
+            t.setDaemon(True)
+            t.start()
+
+        while workers:
+            lines = events.get()
+            if lines is None:
+                workers -= 1
+                continue
+            for line in lines:
+                yield line
+
+        # Whatever was left over because connections failed is not on
+        # the server.
+        while 1:
+            try:
+                failed.add(tasks.get_nowait()[0])
+            except Empty:
+                break
 
     def consolidate_listing(self, con, current_artifacts):
         server_artifacts, duplicates = self.read_existing_artifacts(con)
@@ -377,13 +572,38 @@ class FtpPublisher(Publisher):
             yield event
 
         yield '000 Begin sync ...'
+        connections = self.get_connection_count(target_url)
         current_artifacts = {}
+        pending = []
+        failed = set()
         for artifact_name, filename, checksum in self.iter_artifacts():
             current_artifacts[artifact_name] = checksum
             if checksum != committed_artifacts.get(artifact_name):
-                self.upload_artifact(con, artifact_name, filename, checksum)
+                if connections > 1:
+                    pending.append((artifact_name, filename, checksum))
+                    continue
+                if not self.upload_artifact(con, artifact_name, filename,
+                                            checksum):
+                    failed.add(artifact_name)
                 for event in con.drain_log():
                     yield event
+
+        # With multiple connections the listing is written once at the
+        # end when the server state is consolidated.
+        if pending:
+            for event in self.upload_artifacts_parallel(
+                    con, target_url, credentials, pending, connections,
+                    failed):
+                yield event
+
+        # Failed uploads are kept out of the listing so that they are
+        # tried again with the next deploy.
+        for artifact_name in failed:
+            if artifact_name in committed_artifacts:
+                current_artifacts[artifact_name] = \
+                    committed_artifacts[artifact_name]
+            else:
+                del current_artifacts[artifact_name]
         yield '000 Sync done!'
 
         yield '000 Consolidating server state ...'
@@ -400,56 +620,74 @@ class FtpTlsPublisher(FtpPublisher):
 
 class GithubPagesPublisher(Publisher):
 
-    @contextmanager
-    def temporary_repo(self):
-        folder = tempfile.mkdtemp()
-        repo = os.path.join(folder, 'repo')
-        os.mkdir(repo)
-        os.chmod(repo, 0755)
-        try:
-            yield repo
-        finally:
-            try:
-                shutil.rmtree(folder)
-            except (IOError, OSError):
-                pass
+    def get_repo_path(self, target_url):
+        """Returns the path of the working clone for a target.  The clone
+        is kept in the deploy cache of the project so that later deploys
+        only need to fetch and commit what changed.
+        """
+        key = self.get_server_key(target_url).encode('utf-8')
+        return os.path.join(self.env.project.get_deploy_cache_path(),
+                            'ghpages', hashlib.md5(key).hexdigest())
 
     def get_credentials(self, url, credentials=None):
+        """Returns the git options and environment variables that pass
+        the credentials to git.  They are only handed to the commands
+        that talk to the remote and never written to disk.
+        """
         credentials = credentials or {}
         username = credentials.get('username') or url.username
         password = credentials.get('password') or url.password
-        rv = username
-        if username and password:
-            rv += ':' + password
-        return rv and rv.encode('utf-8') or None
-
-    def update_git_config(self, repo, url, branch, credentials=None):
+        if not username:
+            return [], {}
+        env = {'LEKTOR_GIT_USERNAME': username.encode('utf-8')}
+        if password:
+            env['LEKTOR_GIT_PASSWORD'] = password.encode('utf-8')
+        helper = ('!f() { test "$1" = get || return; '
+                  'echo "username=$LEKTOR_GIT_USERNAME"; '
+                  'test -n "$LEKTOR_GIT_PASSWORD" && '
+                  'echo "password=$LEKTOR_GIT_PASSWORD"; }; f')
+        # The empty helper resets helpers from the user's configuration.
+        return ['-c', 'credential.helper=',
+                '-c', 'credential.helper=' + helper], env
+
+    def get_push_url(self, url):
         path = (url.host + u'/' + url.path.strip(u'/')).encode('utf-8')
         if url.scheme in ('ghpages', 'ghpages+ssh'):
-            push_url = 'git@github.com:%s.git' % path
-        else:
-            push_url = 'https://github.com/%s' % path
-
-        cred = self.get_credentials(url, credentials)
-        if cred:
-            cred_path = os.path.join(repo, '.git', 'credentials')
-            with open(cred_path, 'w') as f:
-                f.write('https://%s@github.com\n' % cred)
-
-        with open(os.path.join(repo, '.git', 'config'), 'a') as f:
-            f.write('[remote "origin"]\nurl = %s\n'
-                    'fetch = +refs/heads/%s:refs/remotes/origin/%s\n' %
-                    (push_url, branch, branch))
-            if url.auth:
-                f.write('[credential]\nhelper = store --file "%s"\n' %
-                        cred_path)
+            return 'git@github.com:%s.git' % path
+        return 'https://github.com/%s' % path
 
-    def link_artifacts(self, path):
+    def update_git_config(self, repo, url, branch):
+        def set_config(key, value):
+            Command(['git', 'config', key, value], cwd=repo,
+                    capture=False).wait()
+
+        set_config('remote.origin.url', self.get_push_url(url))
+        set_config('remote.origin.fetch',
+                   '+refs/heads/%s:refs/remotes/origin/%s' % (branch, branch))
+
+    def link_artifact(self, path, artifact_name):
         try:
             link = os.link
         except AttributeError:
             link = shutil.copy
 
+        src = os.path.join(self.output_path, *artifact_name.split('/'))
+        dst = os.path.join(path, *artifact_name.split('/'))
+        try:
+            os.makedirs(os.path.dirname(dst))
+        except (OSError, IOError):
+            pass
+        try:
+            os.remove(dst)
+        except OSError:
+            pass
+        try:
+            link(src, dst)
+        except OSError:
+            # The deploy cache can be on another device than the output.
+            shutil.copy(src, dst)
+
+    def link_artifacts(self, path):
         # Clean old
         for filename in os.listdir(path):
             if filename == '.git':
@@ -465,14 +703,10 @@ class GithubPagesPublisher(Publisher):
             dirnames[:] = [x for x in dirnames if x != '.lektor']
             for filename in filenames:
                 full_path = os.path.join(self.output_path, dirpath, filename)
-                dst = os.path.join(path, full_path[len(self.output_path):]
+                self.link_artifact(path, full_path[len(self.output_path):]
                                    .lstrip(os.path.sep)
-                                   .lstrip(os.path.altsep or ''))
-                try:
-                    os.makedirs(os.path.dirname(dst))
-                except (OSError, IOError):
-                    pass
-                link(full_path, dst)
+                                   .lstrip(os.path.altsep or '')
+                                   .replace(os.path.sep, '/'))
 
     def write_cname(self, path, target_url):
         params = target_url.decode_query()
@@ -480,6 +714,8 @@ class GithubPagesPublisher(Publisher):
         if cname is not None:
             with open(os.path.join(path, 'CNAME'), 'w') as f:
                 f.write('%s\n' % cname.encode('utf-8'))
+            return True
+        return False
 
     def publish(self, target_url, credentials=None):
         if not locate_executable('git'):
@@ -492,31 +728,98 @@ class GithubPagesPublisher(Publisher):
         else:
             branch = 'gh-pages'
 
-        with self.temporary_repo() as path:
-            def git(args, capture=True):
-                cmd = Command(['git'] + args, cwd=path, capture=capture)
-                if capture:
-                    return cmd.safe_iter()
-                return cmd
-
-            for line in git(['init']):
-                yield line
-            self.update_git_config(path, target_url, branch,
-                                   credentials)
-            for line in git(['remote', 'update']):
+        path = self.get_repo_path(target_url)
+        server = self.get_server_key(target_url)
+        cred_args, cred_env = self.get_credentials(target_url, credentials)
+
+        def git(args, capture=True, remote=False):
+            if remote:
+                args = cred_args + args
+            cmd = Command(['git'] + args, cwd=path, capture=capture,
+                          env=remote and cred_env or None)
+            if capture:
+                return cmd.safe_iter()
+            return cmd
+
+        # Older versions kept the clone together with the credentials in
+        # the output folder.
+        old_path = os.path.join(self.output_path, '.lektor', 'ghpages')
+        if os.path.isdir(old_path):
+            shutil.rmtree(old_path, ignore_errors=True)
+
+        def git_paths(args, paths):
+            for idx in xrange(0, len(paths), 500):
+                for line in git(args + ['--'] + paths[idx:idx + 500]):
+                    yield line
+
+        if not os.path.isdir(os.path.join(path, '.git')):
+            try:
+                os.makedirs(path)
+            except OSError:
+                pass
+            for line in git(['init', '-q']):
                 yield line
+            fresh_clone = True
+        else:
+            fresh_clone = False
+        self.update_git_config(path, target_url, branch)
+
+        # Only the tip of the branch is fetched.  The index is reset to
+        # it while the working tree stays what we published last time.
+        git(['symbolic-ref', 'HEAD', 'refs/heads/' + branch],
+            capture=False).wait()
+        if git(['fetch', '-q', '--depth', '1', 'origin'],
+               capture=False, remote=True).wait() == 0:
+            git(['reset', '-q', 'refs/remotes/origin/' + branch],
+                capture=False).wait()
+        else:
+            fresh_clone = True
+
+        with self.open_build_state() as build_state:
+            if build_state is not None:
+                build_state.update_artifact_checksums()
+                delta = build_state.get_publish_delta(server)
+                if not build_state.has_published_manifest(server):
+                    fresh_clone = True
+
+            if build_state is None or fresh_clone:
+                self.link_artifacts(path)
+                self.write_cname(path, target_url)
+                for line in git(['add', '-f', '--all', '.']):
+                    yield line
+            elif not delta:
+                yield 'Nothing to publish.'
+                return
+            else:
+                changed = []
+                removed = []
+                for artifact_name, checksum in delta:
+                    if checksum is None:
+                        prune_file_and_folder(os.path.join(
+                            path, *artifact_name.split('/')), path)
+                        removed.append(artifact_name)
+                    else:
+                        self.link_artifact(path, artifact_name)
+                        changed.append(artifact_name)
+                if self.write_cname(path, target_url):
+                    changed.append('CNAME')
+                for line in git_paths(['add', '-f'], changed):
+                    yield line
+                for line in git_paths(['rm', '-q', '--cached',
+                                       '--ignore-unmatch'], removed):
+                    yield line
 
-            if git(['checkout', '-q', branch], capture=False).wait() != 0:
-                git(['checkout', '-qb', branch], capture=False).wait()
-
-            self.link_artifacts(path)
-            self.write_cname(path, target_url)
-            for line in git(['add', '-f', '--all', '.']):
-                yield line
             for line in git(['commit', '-qm', 'Synchronized build']):
                 yield line
-            for line in git(['push', 'origin', branch]):
-                yield line
+            push = Command(['git'] + cred_args + ['push', 'origin', branch],
+                           cwd=path, env=cred_env)
+            with push:
+                for line in push:
+                    yield line
+            if push.wait() != 0:
+                raise PublishError('Could not push to the remote.')
+            if build_state is not None:
+                build_state.record_published_artifacts(server, delta)
 
 
 publishers = {
@@ -78,11 +78,10 @@ class SourceObject(object):
         return this_path[:len(crumbs)] == crumbs and \
             (not strict or len(this_path) > len(crumbs))
 
-    def url_to(self, path, alt=None, absolute=False, external=False):
-        """Calculates the URL from the current source object to the given
-        other source object.  Alternatively a path can also be provided
-        instead of a source object.  If the path starts with a leading
-        bang (``!``) then no resolving is performed.
+    def resolve_url_target(self, path, alt=None):
+        """Resolves the target of :meth:`url_to` into an absolute URL path.
+        The return value is a tuple of that path and the source object the
+        target was resolved to or `None` if no resolving happened.
         """
         if alt is None:
             alt = getattr(path, 'alt', None)
@@ -95,11 +94,22 @@ class SourceObject(object):
             resolve = False
             path = path[1:]
 
+        source = None
         if resolve:
             source = self.pad.get(posixpath.join(self.path, path), alt=alt)
             if source is not None:
                 path = source.url_path
 
+        return path, source
+
+    def url_to(self, path, alt=None, absolute=False, external=False):
+        """Calculates the URL from the current source object to the given
+        other source object.  Alternatively a path can also be provided
+        instead of a source object.  If the path starts with a leading
+        bang (``!``) then no resolving is performed.
+        """
+        path = self.resolve_url_target(path, alt)[0]
+
         if absolute:
             return path
         elif external:
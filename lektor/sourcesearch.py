@@ -24,9 +24,9 @@ def _id_from_path(path):
         return ''
 
 
-def _mapping_from_cursor(cur):
+def _mapping_from_rows(rows):
     rv = {}
-    for path, alt, lang, type, title in cur.fetchall():
+    for path, alt, lang, type, title in rows:
         rv.setdefault(path, []).append({
             'id': _id_from_path(path),
             'path': path,
@@ -50,7 +50,7 @@ def _build_parent_path(path, mapping, alt, lang):
     rv = []
     for parent in _iter_parents(path):
         info = _find_best_info(mapping.get(parent) or [], alt, lang)
-        id = _id_from_path(info['path'])
+        id = _id_from_path(parent)
         if info is None:
             title = id or '(Index)'
         else:
@@ -63,39 +63,84 @@ def _build_parent_path(path, mapping, alt, lang):
     return rv
 
 
-def _process_search_results(builder, cur, alt, lang, limit):
-    mapping = _mapping_from_cursor(cur)
-    rv = []
-
-    files_needed = set()
+def _process_search_results(rows, alt, lang, limit):
+    # The query returns the hits in order first, followed by the source
+    # infos of all their parents.
+    hits = []
+    parent_rows = []
+    for is_parent, path, alt_, lang_, type, title in rows:
+        if is_parent:
+            parent_rows.append((path, alt_, lang_, type, title))
+        else:
+            hits.append((path, alt_, lang_, type, title))
 
-    for path, infos in mapping.iteritems():
-        info = _find_best_info(infos, alt, lang)
+    hit_mapping = _mapping_from_rows(hits)
+    mapping = _mapping_from_rows(parent_rows)
+    rv = []
+    seen = set()
+    for row in hits:
+        path = row[0]
+        if path in seen:
+            continue
+        seen.add(path)
+        info = _find_best_info(hit_mapping[path], alt, lang)
         if info is None:
             continue
-
-        for parent in _iter_parents(path):
-            if parent not in mapping:
-                files_needed.add(parent)
-
         rv.append(info)
         if len(rv) == limit:
             break
 
-    if files_needed:
-        cur.execute('''
-            select path, alt, lang, type, title
-              from source_info
-             where path in (%s)
-        ''' % ', '.join(['?'] * len(files_needed)), list(files_needed))
-        mapping.update(_mapping_from_cursor(cur))
-
     for info in rv:
         info['parents'] = _build_parent_path(info['path'], mapping, alt, lang)
 
     return rv
 
 
+def has_search_index(cur):
+    """Checks if the full text index for source infos exists."""
+    cur.execute('''
+        select count(*) from sqlite_master
+         where type = 'table' and name = 'source_info_search'
+    ''')
+    return cur.fetchone()[0] > 0
+
+
+def _execute_search(cur, hits_query, args):
+    """Runs a query for search hits and returns the source infos of all
+    their parents along in the same query so that the breadcrumbs can
+    be built.  The hits query needs to return the columns of a source
+    info plus an `is_prefix` and a `score` column to order by.
+    """
+    cur.execute('''
+        with recursive
+        hits as (%s),
+        parents (path) as (
+            select path from hits
+            union
+            -- Strips the last segment off the path, the root is '/'.
+            select coalesce(nullif(rtrim(rtrim(path,
+                       replace(path, '/', '')), '/'), ''), '/')
+              from parents
+             where path != '/'
+        )
+        select 0, path, alt, lang, type, title, is_prefix, score
+          from hits
+     union all
+        select 1, path, alt, lang, type, title, 0, 0
+          from source_info
+         where path in (select path from parents)
+      order by 1, 7 desc, 8, 6 collate nocase
+    ''' % hits_query, args)
+    return [row[:6] for row in cur.fetchall()]
+
+
+#: The number of index matches that are ranked at most.  Ranking every
+#: match of a broad query takes too long, so only the first matches in
+#: index order are ranked, together with the titles that start with the
+#: query which are looked up separately.
+max_candidates = 250
+
+
 def find_files(builder, query, alt=PRIMARY_ALT, lang=None, limit=50, types=None):
     if types is None:
         types = ['page']
@@ -111,26 +156,61 @@ def find_files(builder, query, alt=PRIMARY_ALT, lang=None, limit=50, types=None)
         alts.append(alt)
 
     query = query.strip()
-    title_like = '%' + query + '%'
-    path_like = '/%' + query.rstrip('/') + '%'
+    like_query = query.replace('%', '').replace('_', '')
+    filters = 'lang in (%s) and alt in (%s) and type in (%s)' % (
+        ', '.join(['?'] * len(languages)),
+        ', '.join(['?'] * len(alts)),
+        ', '.join(['?'] * len(types)))
+    filter_args = languages + alts + types
 
     con = sqlite3.connect(builder.buildstate_database_filename, timeout=10)
     try:
         cur = con.cursor()
-        cur.execute('''
-            select path, alt, lang, type, title
-              from source_info
-             where (title like ? or path like ?)
-               and lang in (%s)
-               and alt in (%s)
-               and type in (%s)
-          order by title
-           collate nocase
-             limit ?
-        ''' % (', '.join(['?'] * len(languages)),
-               ', '.join(['?'] * len(alts)),
-               ', '.join(['?'] * len(types))),
-               [title_like, path_like] + languages + alts + types + [limit * 2])
-        return _process_search_results(builder, cur, alt, lang, limit)
+        # The trigram index can only match queries of three or more
+        # characters.  Shorter ones have to scan the table.
+        if len(query) >= 3 and has_search_index(cur):
+            # The index holds everything that is needed, so the matches
+            # are filtered within it and only a limited number of them is
+            # ranked: prefix matches of the title first, then title
+            # matches, then shorter titles.
+            rows = _execute_search(cur, '''
+                select path, alt, lang, type, title,
+                       title like ? as is_prefix,
+                       (title like ?) * -1000 + length(title) as score
+                  from (select * from (
+                            select path, alt, lang, type, title
+                              from source_info_search
+                             where source_info_search match ?
+                               and %s
+                             limit ?)
+                         union
+                        select * from (
+                            select path, alt, lang, type, title
+                              from source_info
+                             where title >= ? collate nocase
+                               and title < ? collate nocase
+                               and %s
+                             limit ?))
+              order by is_prefix desc, score
+                 limit ?
+            ''' % (filters, filters),
+                [like_query + '%', '%' + like_query + '%',
+                 '"%s"' % query.replace('"', '""')] +
+                filter_args + [max_candidates, query, query + u'\uffff'] +
+                filter_args + [max_candidates, limit * 2])
+        else:
+            rows = _execute_search(cur, '''
+                select path, alt, lang, type, title,
+                       0 as is_prefix, 0 as score
+                  from source_info
+                 where (title like ? or path like ?)
+                   and %s
+              order by title
+               collate nocase
+                 limit ?
+            ''' % filters,
+                ['%' + query + '%', '/%' + query.rstrip('/') + '%'] +
+                filter_args + [limit * 2])
+        return _process_search_results(rows, alt, lang, limit)
     finally:
         con.close()
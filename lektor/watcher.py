@@ -21,22 +21,39 @@ class EventHandler(FileSystemEventHandler):
 
     def on_any_event(self, event):
         if not isinstance(event, DirModifiedEvent):
-            item = (time.time(), event.event_type, event.src_path)
-            if self.queue is not None:
-                self.queue.put(item)
-            else:
-                self.callback(*item)
+            # Moves are reported for both paths: a renamed file vanishes
+            # from its old location, and files that are written atomically
+            # show up as moved from a temporary file.
+            paths = [event.src_path]
+            dest_path = getattr(event, 'dest_path', None)
+            if dest_path:
+                paths.append(dest_path)
+            now = time.time()
+            for path in paths:
+                item = (now, event.event_type, path)
+                if self.queue is not None:
+                    self.queue.put(item)
+                else:
+                    self.callback(*item)
 
 
 class BasicWatcher(object):
 
     def __init__(self, paths, callback=None):
+        if callback is not None:
+            callback = self._make_filtered_callback(callback)
         self.event_handler = EventHandler(callback=callback)
         self.observer = Observer()
         for path in paths:
             self.observer.schedule(self.event_handler, path, recursive=True)
         self.observer.setDaemon(True)
 
+    def _make_filtered_callback(self, callback):
+        def filtered_callback(*item):
+            if self.is_interesting(*item):
+                callback(*item)
+        return filtered_callback
+
     def is_interesting(self, time, event_type, path):
         return True
 
@@ -54,10 +71,10 @@ class BasicWatcher(object):
 
 class Watcher(BasicWatcher):
 
-    def __init__(self, env, output_path=None):
-        BasicWatcher.__init__(self, paths=[env.root_path])
+    def __init__(self, env, output_path=None, callback=None):
         self.env = env
         self.output_path = output_path
+        BasicWatcher.__init__(self, paths=[env.root_path], callback=callback)
 
     def is_interesting(self, time, event_type, path):
         if self.env.is_uninteresting_source_name(os.path.basename(path)):
@@ -0,0 +1,53 @@
+"""Micro benchmarks for the metaformat tokenizer.  This compares the bulk
+tokenizer against the original line based implementation::
+
+    $ python tests/bench_metaformat.py
+"""
+import os
+import timeit
+from io import BytesIO
+
+from lektor.metaformat import tokenize
+from test_metaformat import legacy_tokenize
+
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+
+def make_sources():
+    with open(os.path.join(here, 'demo-project', 'content',
+                           'contents.lr'), 'rb') as f:
+        demo = f.read()
+    paragraph = b'Lorem ipsum dolor sit amet, consectetur adipisici elit.\n'
+    long_body = b'title: Long\n---\nbody:\n\n' + paragraph * 2000
+    many_fields = b'---\n'.join(b'field%d: value %d\n' % (x, x)
+                                for x in range(500))
+    escaped = b'body:\n\n' + (paragraph * 20 + b'----\n') * 100
+    return [
+        ('demo contents.lr', demo),
+        ('long body', long_body),
+        ('many fields', many_fields),
+        ('escaped dashes', escaped),
+    ]
+
+
+def bench(func, source, interesting_keys=None, number=200):
+    def run():
+        for _ in func(BytesIO(source), interesting_keys=interesting_keys,
+                      encoding='utf-8'):
+            pass
+    return min(timeit.repeat(run, number=number, repeat=3)) / number
+
+
+def main():
+    for name, source in make_sources():
+        for keys in None, set(['title', '_model']):
+            old = bench(legacy_tokenize, source, keys)
+            new = bench(tokenize, source, keys)
+            print '%-18s %-10s legacy: %8.1fus  bulk: %8.1fus  (%.1fx)' % (
+                name, keys and 'projected' or 'all',
+                old * 1e6, new * 1e6, old / new)
+
+
+if __name__ == '__main__':
+    main()
@@ -17,6 +17,22 @@ def env(request, project):
     return Environment(project)
 
 
+@pytest.fixture(scope='function')
+def scratch_project(request, tmpdir):
+    """A copy of the demo project that tests are free to modify."""
+    from lektor.project import Project
+    path = tmpdir.join('scratch-project').strpath
+    shutil.copytree(os.path.join(os.path.dirname(__file__),
+                                 'demo-project'), path)
+    return Project.from_path(path)
+
+
+@pytest.fixture(scope='function')
+def scratch_env(request, scratch_project):
+    from lektor.environment import Environment
+    return Environment(scratch_project)
+
+
 @pytest.fixture(scope='function')
 def pad(request, env):
     from lektor.db import Database
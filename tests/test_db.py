@@ -199,3 +199,595 @@ def test_is_child_of(pad):
     child = projects.children.first()
     assert child.is_child_of(projects)
     assert child.is_child_of(projects, strict=True)
+
+
+def test_lazy_field_deserialization(pad):
+    from lektor.datamodel import RecordData
+    project = pad.get('/projects/wolf')
+
+    assert isinstance(project._data, RecordData)
+    raw = dict.__getitem__(project._data, 'name')
+    assert not isinstance(raw, unicode)
+
+    assert project['name'] == 'Wolf'
+    assert dict.__getitem__(project._data, 'name') == u'Wolf'
+
+
+def test_query_projection_loading(pad, F):
+    projects = pad.query('/projects').filter(F._slug == 'wolf').all()
+    assert len(projects) == 1
+    wolf = projects[0]
+
+    # Ordering needs the name, everything else is not read yet.
+    assert dict.__getitem__(wolf._data, 'name') == 'Wolf'
+    raw = dict.__getitem__(wolf._data, 'website')
+    assert raw.value is Ellipsis
+
+    assert wolf['website'].host == 'wolfproject.invalid'
+    assert dict.__getitem__(wolf._data, 'description').value is not Ellipsis
+
+
+def test_record_dependency_tracking(pad, builder):
+    from lektor.context import Context
+
+    projects = pad.db.datamodels['projects']
+    project = pad.db.datamodels['project']
+    assert projects.dependent_models == frozenset([project])
+
+    with builder.new_build_state() as build_state:
+        artifact = build_state.new_artifact('index.html')
+        with Context(artifact) as ctx:
+            page = pad.get('/projects')
+            assert projects.filename in ctx.referenced_dependencies
+            assert project.filename in ctx.referenced_dependencies
+            assert ('/projects', '_primary') in ctx.tracked_records
+
+            # Already tracked records still report to dependency collectors
+            gathered = set()
+            with ctx.gather_dependencies(gathered.add):
+                pad.get('/projects')
+            assert page.source_filename in gathered
+            assert projects.filename in gathered
+
+
+def test_implied_datamodel_cache(scratch_env):
+    import os
+    from lektor.db import Database
+
+    path = scratch_env.root_path
+    db = Database(scratch_env)
+
+    assert db.get_implied_datamodel('/projects/wolf').id == 'project'
+    assert ('/projects', False) in db._implied_model_cache
+
+    # Changing the model of the parent invalidates the cached lookup
+    fn = os.path.join(path, 'content', 'projects', 'contents.lr')
+    with open(fn, 'wb') as f:
+        f.write(b'_model: page\n---\ntitle: Projects\n')
+    os.utime(fn, (0, 0))
+    assert db.get_implied_datamodel('/projects/wolf').id == 'page'
+
+
+def test_url_routes(pad, builder):
+    builder.build_all()
+
+    with builder.new_build_state() as build_state:
+        assert build_state.get_url_route('projects/wolf') == \
+            ('/projects/wolf', 'en', None)
+
+        wolf = pad.resolve_url_path('/projects/wolf/',
+                                    build_state=build_state)
+        assert wolf is not None
+        assert wolf.path == '/projects/wolf'
+
+        # Outdated routes are ignored and fixed up by walking the tree.
+        con = build_state.connect_to_database()
+        con.execute('update url_routes set path = ? where url_path = ?',
+                    ['/projects/bagpipe', 'projects/wolf'])
+        con.commit()
+        con.close()
+        wolf = pad.resolve_url_path('/projects/wolf/',
+                                    build_state=build_state)
+        assert wolf.path == '/projects/wolf'
+        assert build_state.get_url_route('projects/wolf') == \
+            ('/projects/wolf', 'en', None)
+
+
+def test_url_routes_are_checked(scratch_env, tmpdir):
+    import os
+    from lektor.builder import Builder
+
+    wolf = os.path.join(scratch_env.root_path, 'content', 'projects', 'wolf')
+    with open(os.path.join(wolf, 'notes.txt'), 'w') as f:
+        f.write('Notes\n')
+    output_path = str(tmpdir.join('output'))
+    Builder(scratch_env.new_pad(), output_path).build_all()
+
+    # A page that now shadows the routed attachment wins.
+    os.mkdir(os.path.join(wolf, 'notes'))
+    with open(os.path.join(wolf, 'notes', 'contents.lr'), 'w') as f:
+        f.write('_model: page\n---\n_slug: notes.txt\n---\ntitle: Notes\n')
+    builder = Builder(scratch_env.new_pad(), output_path)
+    with builder.new_build_state() as build_state:
+        assert build_state.get_url_route('projects/wolf/notes.txt') == \
+            ('/projects/wolf/notes.txt', '_primary', None)
+        rv = builder.pad.resolve_url_path('/projects/wolf/notes.txt',
+                                          build_state=build_state)
+        assert rv.path == '/projects/wolf/notes'
+
+    # Hidden records are not served from the routes.
+    fn = os.path.join(wolf, 'contents.lr')
+    with open(fn, 'a') as f:
+        f.write('\n---\n_hidden: yes\n')
+    builder = Builder(scratch_env.new_pad(), output_path)
+    with builder.new_build_state() as build_state:
+        assert builder.pad.resolve_url_path(
+            '/projects/wolf/', build_state=build_state) is None
+        assert builder.pad.resolve_url_path(
+            '/projects/wolf/', include_invisible=True,
+            build_state=build_state) == builder.pad.resolve_url_path(
+            '/projects/wolf/', include_invisible=True)
+
+
+def test_url_path_is_memoized(pad):
+    wolf = pad.get('/projects/wolf')
+    assert wolf.url_path == '/projects/wolf/'
+    assert wolf.__dict__['url_path'] == '/projects/wolf/'
+    assert not wolf.is_hidden
+    assert 'is_hidden' in wolf.__dict__
+
+    # The parent slugs come from the cached parent record.
+    assert wolf._parent_slugs == ('', 'projects')
+    assert '_parent_slugs' in pad.get('/projects').__dict__
+
+    page2 = pad.get('/projects', page_num=2)
+    assert page2.url_path == '/projects/page/2/'
+
+
+def test_url_to_caching(pad, builder):
+    from lektor.builder import PathCache
+    from lektor.context import Context
+
+    path_cache = PathCache(builder.env)
+    root = pad.root
+    wolf = pad.get('/projects/wolf')
+    for _ in range(2):
+        with builder.new_build_state(path_cache=path_cache) as build_state:
+            artifact = build_state.new_artifact('index.html', source_obj=root)
+            with Context(artifact) as ctx:
+                assert ctx.url_to('/projects/wolf') == './projects/wolf/'
+                assert wolf.source_filename in ctx.referenced_dependencies
+
+    assert len(path_cache.url_target_cache) == 1
+    assert path_cache.relative_url_cache == {
+        ('/', '/projects/wolf/'): './projects/wolf/'}
+
+
+def test_shared_model_registry(env):
+    from lektor.db import Database
+
+    db1 = Database(env)
+    db2 = Database(env)
+    assert db1.datamodels is db2.datamodels
+    assert db1.flowblocks is db2.flowblocks
+
+    env.invalidate_models()
+    db3 = Database(env)
+    assert db3.datamodels is not db1.datamodels
+    assert sorted(db3.datamodels) == sorted(db1.datamodels)
+
+
+def test_concurrent_builds_are_coalesced(pad, builder):
+    import time
+    import threading
+
+    builds = []
+    def build_func(artifact):
+        builds.append(artifact.artifact_name)
+        time.sleep(0.1)
+        with artifact.open('wb') as f:
+            f.write(b'Hello World!\n')
+
+    def build():
+        with builder.new_build_state() as build_state:
+            artifact = build_state.new_artifact(
+                'index.html', sources=[pad.root.source_filename])
+            builder.build_artifact(artifact, build_func)
+
+    threads = [threading.Thread(target=build) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert builds == ['index.html']
+
+
+def test_find_files(builder):
+    builder.update_all_source_infos()
+
+    results = builder.find_files('wol')
+    assert [x['path'] for x in results] == ['/projects/wolf']
+    assert [x['title'] for x in results[0]['parents']] == \
+        ['Welcome', 'Projects']
+
+    # Title prefix matches are ranked first
+    results = builder.find_files('proj')
+    assert results[0]['path'] == '/projects'
+    assert len(results) == 8
+
+    # Queries too short for the index scan the source infos
+    results = builder.find_files('of')
+    assert [x['path'] for x in results] == ['/projects/coffee']
+
+
+def test_find_files_ranks_filtered_matches(builder):
+    import os
+    from lektor.build_programs import SourceInfo
+
+    filename = os.path.join(builder.env.root_path, 'content', 'contents.lr')
+    infos = [SourceInfo('/other/%d' % x, filename, type='attachment',
+                        title_i18n={'en': 'Long Zebra Title %d' % x})
+             for x in range(600)]
+    infos += [SourceInfo('/many/%d' % x, filename, type='page',
+                         title_i18n={'en': 'A Zebra %03d' % x})
+              for x in range(600)]
+    infos.append(SourceInfo('/zebra', filename, type='page',
+                            title_i18n={'en': 'Zebra'}))
+    with builder.new_build_state() as build_state:
+        build_state.write_source_infos(infos)
+
+    # More matches than are ranked come before the best one, but the
+    # filters are applied first and titles starting with the query are
+    # always considered.
+    results = builder.find_files('zebra', limit=20)
+    assert len(results) == 20
+    assert results[0]['path'] == '/zebra'
+    assert all(x['type'] == 'page' for x in results)
+
+    # The index follows changed titles.
+    with builder.new_build_state() as build_state:
+        build_state.write_source_infos([
+            SourceInfo('/zebra', filename, type='page',
+                       title_i18n={'en': 'Okapi'}),
+            SourceInfo('/zebra', filename, type='page',
+                       title_i18n={'en': 'Okapi'})])
+    assert builder.find_files('zebra', limit=20)[0]['path'] != '/zebra'
+    assert [x['path'] for x in builder.find_files('okapi')] == ['/zebra']
+
+
+def test_update_all_source_infos(scratch_env, tmpdir, monkeypatch):
+    import os
+    from lektor.builder import Builder
+    from lektor.build_programs import PageBuildProgram
+
+    env = scratch_env
+    path = env.root_path
+
+    def get_source_infos(builder):
+        con = builder.connect_to_database()
+        try:
+            return sorted(con.execute('select * from source_info'))
+        finally:
+            con.close()
+
+    serial = Builder(env.new_pad(), str(tmpdir.join('serial')))
+    serial.update_all_source_infos()
+    parallel = Builder(env.new_pad(), str(tmpdir.join('parallel')))
+    parallel.update_all_source_infos(jobs=2)
+    assert get_source_infos(parallel) == get_source_infos(serial)
+
+    described = []
+    original_describe = PageBuildProgram.describe_source_record
+    def describe_source_record(self):
+        described.append(self.source.path)
+        return original_describe(self)
+    monkeypatch.setattr(PageBuildProgram, 'describe_source_record',
+                        describe_source_record)
+
+    # Unchanged sources are skipped
+    Builder(env.new_pad(), str(tmpdir.join('serial'))) \
+        .update_all_source_infos()
+    assert described == []
+
+    fn = os.path.join(path, 'content', 'projects', 'wolf', 'contents.lr')
+    with open(fn, 'ab') as f:
+        f.write(b'\n')
+    builder = Builder(env.new_pad(), str(tmpdir.join('serial')))
+    builder.update_all_source_infos()
+    assert set(described) == set(['/projects/wolf'])
+    assert get_source_infos(builder) == get_source_infos(parallel)
+
+    # Parents can change how their children are described.
+    del described[:]
+    fn = os.path.join(path, 'content', 'projects', 'contents.lr')
+    with open(fn, 'ab') as f:
+        f.write(b'\n')
+    Builder(env.new_pad(), str(tmpdir.join('serial'))) \
+        .update_all_source_infos()
+    assert '/projects/wolf' in described
+    assert '/' not in described
+
+    # So can the project file.
+    del described[:]
+    with open(env.project.project_file, 'ab') as f:
+        f.write(b'\n')
+    Builder(env.new_pad(), str(tmpdir.join('serial'))) \
+        .update_all_source_infos()
+    assert '/' in described
+
+
+def test_child_ids_are_cached(pad):
+    from lektor.db import Tree
+
+    tree = Tree(pad)
+    ids = tree._get_child_ids('/projects')
+    assert '/projects' in pad.db._child_ids_cache
+    pad.db._child_ids_cache['/projects'][1].pop()
+    assert Tree(pad)._get_child_ids('/projects') == ids[:-1]
+
+
+def test_child_ids_notice_new_pages(scratch_env):
+    import os
+    from lektor.db import Database, Tree
+
+    pad = Database(scratch_env).new_pad()
+    projects = os.path.join(scratch_env.root_path, 'content', 'projects')
+    os.mkdir(os.path.join(projects, 'later'))
+    assert 'later' not in Tree(pad)._get_child_ids('/projects')
+
+    # Adding the contents file does not touch the parent folder.
+    st = os.stat(projects)
+    with open(os.path.join(projects, 'later', 'contents.lr'), 'w') as f:
+        f.write('title: Later\n')
+    os.utime(os.path.join(projects, 'later'), (0, 0))
+    os.utime(projects, (st.st_atime, st.st_mtime))
+    assert 'later' in Tree(pad)._get_child_ids('/projects')
+
+
+def test_change_feed(scratch_env, tmpdir):
+    import os
+    import json
+    import shutil
+    from lektor.builder import Builder
+    from lektor.pluginsystem import Plugin
+
+    env = scratch_env
+    path = env.root_path
+    events = []
+
+    class ChangePlugin(Plugin):
+        def on_after_build_all(self, builder, changes, **extra):
+            events.append(changes)
+    env.plugin_controller.instanciate_plugin('changes', ChangePlugin)
+
+    def build():
+        builder = Builder(env.new_pad(), str(tmpdir.join('output')))
+        builder.build_all()
+        builder.prune()
+        with open(builder.change_feed_filename) as f:
+            return [json.loads(x) for x in f]
+
+    feed = build()
+    assert {'type': 'created', 'artifact': 'projects/wolf/index.html',
+            'url_path': '/projects/wolf/'} in feed
+    assert all(x['type'] == 'created' for x in feed)
+    assert events[-1] == feed
+
+    assert build() == []
+    assert events[-1] == []
+
+    fn = os.path.join(path, 'content', 'projects', 'wolf', 'contents.lr')
+    with open(fn, 'ab') as f:
+        f.write(b'\nMore text.\n')
+    feed = build()
+    assert set(x['type'] for x in feed) == set(['changed'])
+    assert sorted(x['url_path'] for x in feed) == \
+        ['/de/projects/wolf/', '/projects/wolf/']
+
+    shutil.rmtree(os.path.dirname(fn))
+    feed = build()
+    assert {'type': 'pruned', 'artifact': 'projects/wolf/index.html',
+            'url_path': '/projects/wolf/'} in feed
+
+    # Pruning on its own starts a new feed as well.
+    builder = Builder(env.new_pad(), str(tmpdir.join('output')))
+    builder.prune()
+    with open(builder.change_feed_filename) as f:
+        assert f.read() == ''
+
+
+def test_precompressed_siblings(scratch_project, tmpdir):
+    import os
+    import gzip
+    import shutil
+    from lektor.environment import Environment
+    from lektor.builder import Builder
+
+    path = scratch_project.tree
+    with open(scratch_project.project_file, 'a') as f:
+        f.write('\n[project]\nprecompress = gzip\n')
+    env = Environment(scratch_project)
+    output_path = str(tmpdir.join('output'))
+    with open(os.path.join(path, 'assets', 'static', 'logo.png'), 'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\n')
+
+    def build():
+        builder = Builder(env.new_pad(), output_path)
+        builder.build_all()
+        builder.prune()
+
+    def output(*parts):
+        return os.path.join(output_path, *parts)
+
+    build()
+    for name in ('index.html', 'static/demo.css'):
+        with open(output(*name.split('/')), 'rb') as f:
+            contents = f.read()
+        with gzip.open(output(*name.split('/')) + '.gz', 'rb') as f:
+            assert f.read() == contents
+    assert os.path.isfile(output('static', 'logo.png'))
+    assert not os.path.exists(output('static', 'logo.png.gz'))
+
+    # Unchanged output is not compressed again
+    gz = output('projects', 'wolf', 'index.html.gz')
+    os.utime(gz, (0, 0))
+    os.utime(output('projects', 'wolf', 'index.html'), (0, 0))
+    fn = os.path.join(path, 'content', 'projects', 'wolf', 'contents.lr')
+    with open(fn, 'ab') as f:
+        f.write(b'\n')
+    build()
+    assert os.stat(output('projects', 'wolf', 'index.html')).st_mtime != 0
+    assert os.stat(gz).st_mtime == 0
+
+    # Siblings are pruned together with their artifact
+    shutil.rmtree(os.path.dirname(fn))
+    build()
+    assert not os.path.exists(gz)
+
+    # Building a single source waits for its compression
+    os.remove(output('index.html.gz'))
+    with open(os.path.join(path, 'content', 'contents.lr'), 'ab') as f:
+        f.write(b'\n')
+    builder = Builder(env.new_pad(), output_path)
+    builder.build(builder.pad.root)
+    assert os.path.isfile(output('index.html.gz'))
+    assert builder.precompressor._pending == []
+
+    # Siblings of formats that are no longer configured are pruned, but
+    # assets that merely share their name are kept.
+    for name in 'archive.txt', 'archive.txt.gz':
+        with open(os.path.join(path, 'assets', 'static', name), 'wb') as f:
+            f.write(b'x')
+    build()
+    with open(scratch_project.project_file) as f:
+        project_file = f.read()
+    with open(scratch_project.project_file, 'w') as f:
+        f.write(project_file.replace('precompress = gzip', ''))
+    env = Environment(scratch_project)
+    build()
+    assert not os.path.exists(output('index.html.gz'))
+    assert not os.path.exists(output('static', 'demo.css.gz'))
+    assert os.path.isfile(output('static', 'archive.txt.gz'))
+
+
+def test_fingerprinted_assets(scratch_project, tmpdir):
+    import os
+    from lektor.environment import Environment
+    from lektor.builder import Builder
+
+    path = scratch_project.tree
+    with open(scratch_project.project_file, 'a') as f:
+        f.write('\n[project]\nfingerprint_assets = yes\n'
+                'precompress = gzip\n')
+    layout = os.path.join(path, 'templates', 'layout.html')
+    with open(layout) as f:
+        contents = f.read()
+    with open(layout, 'w') as f:
+        f.write(contents.replace("'/static/style.css'|url",
+                                 "'/static/demo.css'|asseturl"))
+    # Assets that merely look fingerprinted and assets that are not
+    # linked with asseturl are left alone.
+    assets = os.path.join(path, 'assets', 'static')
+    with open(os.path.join(assets, 'app.deadbeef.css'), 'w') as f:
+        f.write('body { color: red }\n')
+    env = Environment(scratch_project)
+    output_path = str(tmpdir.join('output'))
+
+    def build():
+        builder = Builder(env.new_pad(), output_path)
+        builder.build_all()
+        builder.prune()
+        return builder
+
+    def change_asset():
+        with open(os.path.join(assets, 'demo.css'), 'a') as f:
+            f.write('\nbody { margin: 0 }\n')
+        builder = build()
+        with builder.new_build_state() as build_state:
+            return build_state.get_asset_fingerprint(
+                builder.pad.get_asset('/static/demo.css'))
+
+    def get_stylesheets():
+        with open(os.path.join(output_path, 'projects', 'wolf',
+                               'index.html')) as f:
+            return [x.strip() for x in f if 'stylesheet' in x]
+
+    def get_static_files(*fingerprints):
+        rv = ['app.deadbeef.css', 'app.deadbeef.css.gz',
+              'demo.css', 'demo.css.gz']
+        for fingerprint in fingerprints:
+            name = 'demo.%s.css' % fingerprint
+            rv += [name, name + '.gz']
+        return sorted(rv)
+
+    builder = build()
+    with builder.new_build_state() as build_state:
+        asset = builder.pad.get_asset('/static/demo.css')
+        fingerprint = build_state.get_asset_fingerprint(asset)
+    assert get_stylesheets() == [
+        '<link href="../../static/demo.%s.css" rel="stylesheet">'
+        % fingerprint]
+    static = os.path.join(output_path, 'static')
+    assert sorted(os.listdir(static)) == get_static_files(fingerprint)
+    with open(os.path.join(static, 'demo.css'), 'rb') as f:
+        contents = f.read()
+    with open(os.path.join(static, 'demo.%s.css' % fingerprint), 'rb') as f:
+        assert f.read() == contents
+
+    # Fingerprinted URLs resolve to the asset
+    assert builder.pad.resolve_url_path(
+        '/static/demo.%s.css' % fingerprint).source_filename == \
+        asset.source_filename
+
+    # A changed asset gets a new name and pages referencing it are
+    # rebuilt.  One older copy is kept for cached pages by default.
+    second_fingerprint = change_asset()
+    assert second_fingerprint != fingerprint
+    assert sorted(os.listdir(static)) == \
+        get_static_files(fingerprint, second_fingerprint)
+    assert get_stylesheets() == [
+        '<link href="../../static/demo.%s.css" rel="stylesheet">'
+        % second_fingerprint]
+
+    third_fingerprint = change_asset()
+    assert sorted(os.listdir(static)) == \
+        get_static_files(second_fingerprint, third_fingerprint)
+
+
+def test_asset_fingerprints_are_cached(builder, monkeypatch):
+    from lektor.builder import Builder
+
+    connections = []
+    connect = Builder.connect_to_database
+
+    def counting_connect(self):
+        connections.append(self)
+        return connect(self)
+    monkeypatch.setattr(Builder, 'connect_to_database', counting_connect)
+
+    asset = builder.pad.get_asset('/static/demo.css')
+    with builder.new_build_state() as build_state:
+        fingerprint = build_state.get_asset_fingerprint(asset)
+        assert build_state.get_asset_fingerprint(asset) == fingerprint
+        assert len(connections) == 1
+
+        # Writing an artifact from the asset forgets the fingerprint
+        artifact = build_state.new_artifact(
+            'static/demo.%s.css' % fingerprint,
+            sources=[asset.source_filename])
+        with artifact.update():
+            with artifact.open('wb') as f:
+                f.write(b'body {}\n')
+        del connections[:]
+        assert build_state.get_asset_fingerprint(asset) == fingerprint
+        assert len(connections) == 1
+
+
+def test_strip_fingerprint():
+    from lektor.assets import get_fingerprinted_name, strip_fingerprint
+
+    assert strip_fingerprint('style.3f2a1b9c.css') == 'style.css'
+    assert strip_fingerprint('LICENSE.3f2a1b9c') == 'LICENSE'
+    assert strip_fingerprint(get_fingerprinted_name(
+        'LICENSE', '3f2a1b9c')) == 'LICENSE'
+    assert strip_fingerprint('style.css') is None
@@ -0,0 +1,142 @@
+import random
+from io import BytesIO
+
+from lektor.metaformat import tokenize, _process_buf
+
+
+def legacy_tokenize(iterable, interesting_keys=None, encoding=None):
+    """The original line by line tokenizer which serves as reference
+    implementation for the bulk tokenizer.
+    """
+    key = []
+    buf = []
+    want_newline = False
+    is_interesting = True
+
+    def _flush_item():
+        the_key = key[0]
+        if not is_interesting:
+            value = None
+        else:
+            value = _process_buf(buf)
+        del key[:], buf[:]
+        return the_key, value
+
+    if encoding is not None:
+        iterable = (x.decode(encoding, 'replace') for x in iterable)
+
+    for line in iterable:
+        line = line.rstrip(u'\r\n') + u'\n'
+
+        if line.rstrip() == u'---':
+            want_newline = False
+            if key:
+                yield _flush_item()
+        elif key:
+            if want_newline:
+                want_newline = False
+                if not line.strip():
+                    continue
+            if is_interesting:
+                buf.append(line)
+        else:
+            bits = line.split(u':', 1)
+            if len(bits) == 2:
+                key = [bits[0].strip()]
+                if interesting_keys is None:
+                    is_interesting = True
+                else:
+                    is_interesting = key[0] in interesting_keys
+                if is_interesting:
+                    first_bit = bits[1].strip(u'\t ')
+                    if first_bit.strip():
+                        buf = [first_bit]
+                    else:
+                        buf = []
+                        want_newline = True
+
+    if key:
+        yield _flush_item()
+
+
+FUZZ_PIECES = [
+    u'', u' ', u'\t', u'\x0c', u'\u3000', u'\r', u'\r\r', u':', u'::',
+    u'-', u'--', u'---', u'----', u'-----', u' ---', u'--- ', u'\t----',
+    u'title', u'body', u'_model', u'a:b', u'  key  : value  ',
+    u'k:', u'k: ', u'Hello World', u'\xfcber', u'\x85', u'\u2028', u'#',
+]
+FUZZ_ENDINGS = [u'\n', u'\n', u'\n', u'\r\n', u'\r\r\n']
+
+
+def make_fuzz_source(rnd):
+    lines = []
+    for _ in range(rnd.randint(0, 25)):
+        line = u''.join(rnd.choice(FUZZ_PIECES)
+                        for _ in range(rnd.randint(0, 3)))
+        lines.append(line + rnd.choice(FUZZ_ENDINGS))
+    if lines and rnd.random() < 0.3:
+        lines[-1] = lines[-1].rstrip(u'\n')
+    source = u''.join(lines).encode('utf-8')
+    if rnd.random() < 0.1:
+        source += b'\xff\xc3'
+    return source
+
+
+def check_equivalent(source, interesting_keys=None):
+    expected = list(legacy_tokenize(BytesIO(source),
+                                    interesting_keys=interesting_keys,
+                                    encoding='utf-8'))
+    rv = list(tokenize(BytesIO(source), interesting_keys=interesting_keys,
+                       encoding='utf-8'))
+    assert rv == expected
+
+    lines = source.decode('utf-8', 'replace').splitlines(True)
+    expected = list(legacy_tokenize(lines, interesting_keys=interesting_keys))
+    rv = list(tokenize(lines, interesting_keys=interesting_keys))
+    assert rv == expected
+
+
+def test_basic_tokenize():
+    source = (b'title: Hello World\n'
+              b'---\n'
+              b'body:\n'
+              b'\n'
+              b'Some text\n'
+              b'----\n'
+              b'more text\n'
+              b'---\n'
+              b'empty: \n')
+    rv = list(tokenize(BytesIO(source), encoding='utf-8'))
+    assert rv == [
+        (u'title', [u'Hello World']),
+        (u'body', [u'Some text\n', u'---\n', u'more text']),
+        (u'empty', []),
+    ]
+    check_equivalent(source)
+    check_equivalent(source, interesting_keys=set(['body']))
+
+
+def test_tokenize_quirks():
+    for source in [
+        b'',
+        b'no key here\n---\n',
+        b'body:\n\n\n  text\n',
+        b'body:\n  \nfirst\n',
+        b'body:\nfirst\n\n',
+        b'body: first  \nsecond\r\n---  \r\nnext:\tx',
+        b'body:\n ---\n  -----  \n---\n',
+        b'body: ----\n',
+        b': no key\n',
+        b'body:\r\r\n\r\nx\r\r',
+        b'a: 1\n---\n---\nb: 2\n--- \t\n',
+    ]:
+        check_equivalent(source)
+        check_equivalent(source, interesting_keys=set(['body', 'next']))
+
+
+def test_tokenize_fuzz():
+    rnd = random.Random(42)
+    for _ in range(2000):
+        source = make_fuzz_source(rnd)
+        check_equivalent(source)
+        check_equivalent(source, interesting_keys=set([u'body', u'k']))
@@ -0,0 +1,399 @@
+import os
+
+import pytest
+
+
+@pytest.fixture(scope='function')
+def webui(request, env, tmpdir):
+    from lektor.admin.webui import WebUI
+    output_path = tmpdir.mkdir('output').strpath
+    return WebUI(env, output_path=output_path)
+
+
+@pytest.fixture(scope='function')
+def watched_webui(request, scratch_env, tmpdir):
+    from lektor.admin.webui import WebUI
+    webui = WebUI(scratch_env, output_path=tmpdir.mkdir('output').strpath)
+    webui.lektor_info.watch()
+
+    def stop():
+        observer = webui.lektor_info.watcher.observer
+        observer.stop()
+        observer.join()
+    request.addfinalizer(stop)
+    return webui
+
+
+@pytest.fixture(scope='function')
+def media_webui(request, scratch_env, tmpdir):
+    from lektor.admin.webui import WebUI
+    with open(os.path.join(scratch_env.root_path, 'assets', 'static',
+                           'video.mp4'), 'wb') as f:
+        for idx in range(256):
+            f.write(chr(idx) * 8192)
+    return WebUI(scratch_env, output_path=tmpdir.mkdir('output').strpath)
+
+
+def test_pads_are_reused(watched_webui):
+    info = watched_webui.lektor_info
+    client = watched_webui.test_client()
+
+    rv = client.get('/projects/wolf/')
+    assert rv.status_code == 200
+    assert len(info._idle_pads) == 1
+    pad = info._idle_pads[0]
+
+    rv = client.get('/projects/coffee/')
+    assert rv.status_code == 200
+    assert info._idle_pads == [pad]
+    assert pad.cache.get('/projects/wolf', alt='en') is not Ellipsis
+
+
+def test_pads_are_not_reused_without_watcher(webui):
+    rv = webui.test_client().get('/projects/wolf/')
+    assert rv.status_code == 200
+    assert webui.lektor_info._idle_pads == []
+
+
+def check_admin_edits_are_visible(webui):
+    import json
+    client = webui.test_client()
+
+    def get_label():
+        rv = client.get('/admin/api/recordinfo?path=/projects')
+        children = json.loads(rv.data)['children']
+        return [x['label_i18n'] for x in children
+                if x['id'] == 'wolf'][0]['en']
+
+    assert get_label() == 'Wolf'
+    assert 'Wolfgang' not in client.get('/projects/wolf/').data
+    rv = client.put('/admin/api/rawrecord', content_type='application/json',
+                    data=json.dumps({'path': '/projects/wolf',
+                                     'data': {'name': 'Wolfgang'}}))
+    assert rv.status_code == 200
+    assert get_label() == 'Wolfgang'
+    assert 'Wolfgang' in client.get('/projects/wolf/').data
+
+    rv = client.post('/admin/api/deleterecord',
+                     data={'path': '/projects/wolf', 'delete_master': '1'})
+    assert rv.status_code == 200
+    rv = client.get('/admin/api/recordinfo?path=/projects')
+    assert 'wolf' not in [x['id'] for x in json.loads(rv.data)['children']]
+
+
+def test_admin_edits_are_visible(scratch_env, tmpdir):
+    from lektor.admin.webui import WebUI
+    check_admin_edits_are_visible(WebUI(
+        scratch_env, output_path=tmpdir.mkdir('output').strpath))
+
+
+def test_admin_edits_are_visible_with_watcher(watched_webui):
+    # The watcher only notices the edits later, so the admin has to
+    # forget the edited records right away.
+    watched_webui.lektor_info.watcher.observer.unschedule_all()
+    check_admin_edits_are_visible(watched_webui)
+
+
+def test_large_pads_are_not_reused(watched_webui):
+    info = watched_webui.lektor_info
+    info.max_pad_records = 3
+    pad, token = info.checkout_pad()
+    pad.get('/projects')
+    info.release_pad(pad, token)
+    assert info._idle_pads == [pad]
+
+    pad, token = info.checkout_pad()
+    pad.get('/projects/wolf')
+    pad.get('/projects/coffee')
+    pad.get('/projects/oven')
+    info.release_pad(pad, token)
+    assert info._idle_pads == []
+
+
+def test_changed_files_evict_records(watched_webui):
+    info = watched_webui.lektor_info
+    pad, token = info.checkout_pad()
+    pad.get('/projects')
+    pad.get('/projects/wolf')
+    pad.get('/projects/coffee')
+    info.release_pad(pad, token)
+
+    info.handle_file_change(0, 'modified', os.path.join(
+        info.env.root_path, 'content', 'projects', 'wolf', 'contents.lr'))
+    assert info._idle_pads == [pad]
+    assert pad.cache.get('/projects/wolf') is Ellipsis
+    assert pad.cache.get('/projects') is Ellipsis
+    assert pad.cache.get('/projects/coffee') is not Ellipsis
+
+    # Pads that were in use while files changed are not reused
+    pad, token = info.checkout_pad()
+    info.handle_file_change(0, 'modified', os.path.join(
+        info.env.root_path, 'templates', 'page.html'))
+    info.release_pad(pad, token)
+    assert info._idle_pads == [pad]
+
+    pad, token = info.checkout_pad()
+    info.handle_file_change(0, 'modified', os.path.join(
+        info.env.root_path, 'databags', 'foo.ini'))
+    info.release_pad(pad, token)
+    assert info._idle_pads == []
+
+
+def test_current_artifacts_are_served_directly(watched_webui):
+    webui = watched_webui
+    info = webui.lektor_info
+    client = webui.test_client()
+
+    rv = client.get('/projects/wolf/')
+    assert rv.status_code == 200
+    artifact_name, filename, generation = \
+        info._known_artifacts['/projects/wolf/']
+    assert artifact_name == 'projects/wolf/index.html'
+
+    builds = []
+    original_build_source = info._build_source
+    def _build_source(*args):
+        builds.append(args[2])
+        return original_build_source(*args)
+    info._build_source = _build_source
+
+    client.get('/projects/wolf/')
+    assert builds == []
+
+    info.handle_file_change(0, 'modified', os.path.join(
+        info.env.root_path, 'templates', 'page.html'))
+    client.get('/projects/wolf/')
+    assert builds == ['/projects/wolf/']
+
+
+def test_atomic_saves_are_picked_up(watched_webui):
+    import time
+    from lektor.utils import atomic_open
+    info = watched_webui.lektor_info
+    pad, token = info.checkout_pad()
+    pad.get('/projects/wolf')
+    info.release_pad(pad, token)
+    generation = info._file_generation
+
+    fn = os.path.join(info.env.root_path, 'content', 'projects', 'wolf',
+                      'contents.lr')
+    with open(fn, 'rb') as f:
+        contents = f.read()
+    with atomic_open(fn, 'wb') as f:
+        f.write(contents + b'\n')
+    for _ in range(100):
+        if info._file_generation != generation:
+            break
+        time.sleep(0.05)
+    assert info._file_generation != generation
+    assert pad.cache.get('/projects/wolf') is Ellipsis
+
+
+def test_renamed_files_are_picked_up(watched_webui):
+    import time
+    info = watched_webui.lektor_info
+    pad, token = info.checkout_pad()
+    pad.get('/projects/wolf')
+    info.release_pad(pad, token)
+
+    # Only the old location of a file moved out of the content folder
+    # tells which record is gone.
+    os.rename(os.path.join(info.env.root_path, 'content', 'projects',
+                           'wolf', 'contents.lr'),
+              os.path.join(info.env.root_path, 'assets', 'wolf.lr'))
+    for _ in range(100):
+        if pad.cache.get('/projects/wolf') is Ellipsis:
+            break
+        time.sleep(0.05)
+    assert pad.cache.get('/projects/wolf') is Ellipsis
+    pad, token = info.checkout_pad()
+    assert pad.get('/projects/wolf') is None
+    info.release_pad(pad, token)
+
+
+def test_stale_while_revalidate(watched_webui):
+    import time
+    webui = watched_webui
+    info = webui.lektor_info
+    info.stale_while_revalidate = True
+    client = webui.test_client()
+
+    client.get('/projects/wolf/')
+    generation = info._known_artifacts['/projects/wolf/'][2]
+    info.handle_file_change(0, 'modified', os.path.join(
+        info.env.root_path, 'templates', 'page.html'))
+
+    rv = client.get('/projects/wolf/')
+    assert rv.status_code == 200
+    for _ in range(100):
+        if not info._revalidating:
+            break
+        time.sleep(0.05)
+    assert info._known_artifacts['/projects/wolf/'][2] == generation + 1
+
+
+def test_conditional_responses(webui):
+    client = webui.test_client()
+
+    rv = client.get('/projects/wolf/')
+    assert rv.status_code == 200
+    assert int(rv.headers['Content-Length']) == len(rv.data)
+    assert 'lektor-edit-link' in rv.data
+    etag = rv.headers['ETag']
+
+    rv = client.get('/projects/wolf/', headers={'If-None-Match': etag})
+    assert rv.status_code == 304
+    assert rv.data == ''
+
+    rv = client.get('/static/demo.css')
+    assert rv.status_code == 200
+    assert int(rv.headers['Content-Length']) == len(rv.data)
+    rv = client.get('/static/demo.css', headers={
+        'If-None-Match': rv.headers['ETag']})
+    assert rv.status_code == 304
+
+
+def test_identical_rebuilds_keep_etag(scratch_env, tmpdir):
+    from lektor.admin.webui import WebUI
+    webui = WebUI(scratch_env, output_path=tmpdir.mkdir('output').strpath)
+    client = webui.test_client()
+
+    rv = client.get('/projects/wolf/')
+    etag = rv.headers['ETag']
+    filename = os.path.join(webui.lektor_info.output_path, 'projects',
+                            'wolf', 'index.html')
+    os.utime(filename, (0, 0))
+    # A change to the source that does not show up in the output.
+    with open(os.path.join(scratch_env.root_path, 'content', 'projects',
+                           'wolf', 'contents.lr'), 'ab') as f:
+        f.write(b'\n')
+
+    rv = client.get('/projects/wolf/', headers={'If-None-Match': etag})
+    assert os.stat(filename).st_mtime != 0
+    assert rv.status_code == 304
+
+
+def test_not_modified_closes_file(webui, monkeypatch):
+    from lektor.admin.modules import serve
+    client = webui.test_client()
+    etag = client.get('/static/demo.css').headers['ETag']
+
+    opened = []
+
+    def tracking_open(*args):
+        f = open(*args)
+        opened.append(f)
+        return f
+    monkeypatch.setattr(serve, 'open', tracking_open, raising=False)
+    rv = client.get('/static/demo.css', headers={'If-None-Match': etag})
+    assert rv.status_code == 304
+    assert [f.closed for f in opened] == [True]
+
+
+def test_range_requests(media_webui):
+    client = media_webui.test_client()
+    url = '/static/video.mp4'
+    size = 256 * 8192
+
+    rv = client.get(url)
+    assert rv.status_code == 200
+    assert rv.headers['Accept-Ranges'] == 'bytes'
+    assert len(rv.data) == size
+    etag = rv.headers['ETag']
+
+    rv = client.get(url, headers={'Range': 'bytes=8190-8193'})
+    assert rv.status_code == 206
+    assert rv.headers['Content-Range'] == 'bytes 8190-8193/%d' % size
+    assert rv.headers['Content-Length'] == '4'
+    assert rv.data == b'\x00\x00\x01\x01'
+
+    rv = client.get(url, headers={'Range': 'bytes=-2'})
+    assert rv.status_code == 206
+    assert rv.data == b'\xff\xff'
+
+    rv = client.get(url, headers={'Range': 'bytes=%d-' % (size - 8193)})
+    assert rv.status_code == 206
+    assert rv.data == b'\xfe' + b'\xff' * 8192
+
+    rv = client.get(url, headers={'Range': 'bytes=0-1,16384-16386'})
+    assert rv.status_code == 206
+    content_type = rv.headers['Content-Type']
+    assert content_type.startswith('multipart/byteranges; boundary=')
+    boundary = content_type.split('=', 1)[1]
+    assert int(rv.headers['Content-Length']) == len(rv.data)
+    parts = rv.data.split(b'--' + boundary)
+    assert parts[0] == b''
+    assert parts[-1] == b'--\r\n'
+    assert parts[1].endswith(b'bytes 0-1/%d\r\n\r\n\x00\x00\r\n' % size)
+    assert parts[2].endswith(
+        b'bytes 16384-16386/%d\r\n\r\n\x02\x02\x02\r\n' % size)
+
+    rv = client.get(url, headers={'Range': 'bytes=%d-' % size})
+    assert rv.status_code == 416
+    assert rv.headers['Content-Range'] == 'bytes */%d' % size
+
+    # A stale If-Range sends the whole file
+    rv = client.get(url, headers={'Range': 'bytes=0-1',
+                                  'If-Range': '"lektor-stale"'})
+    assert rv.status_code == 200
+    assert len(rv.data) == size
+    rv = client.get(url, headers={'Range': 'bytes=0-1', 'If-Range': etag})
+    assert rv.status_code == 206
+    assert rv.data == b'\x00\x00'
+
+
+def test_live_reload_events(webui):
+    import json
+    info = webui.lektor_info
+    client = webui.test_client()
+
+    stream = client.get('/admin/api/events', buffered=False)
+    assert stream.mimetype == 'text/event-stream'
+    events = iter(stream.response)
+    assert json.loads(next(events)[6:]) == {'type': 'connected'}
+    assert len(info._listeners) == 1
+
+    rv = client.get('/projects/wolf/')
+    assert 'admin/api/events' in rv.data
+    assert json.loads(next(events)[6:]) == {
+        'type': 'updated',
+        'artifacts': ['projects/wolf/index.html'],
+    }
+
+    # Pages that are already current do not produce events
+    client.get('/projects/wolf/')
+    queue, = info._listeners
+    assert queue.empty()
+
+    stream.close()
+    assert info._listeners == set()
+
+
+def test_record_info_pagination(webui):
+    import json
+    client = webui.test_client()
+
+    rv = client.get('/admin/api/recordinfo?path=/projects')
+    data = json.loads(rv.data)
+    ids = [x['id'] for x in data['children']]
+    assert ids == ['bagpipe', 'coffee', 'master', 'oven', 'postage',
+                   'slave', 'wolf', 'zaun']
+    assert data['total_children'] == 8
+
+    rv = client.get('/admin/api/recordinfo?path=/projects&offset=2&limit=3')
+    data = json.loads(rv.data)
+    assert [x['id'] for x in data['children']] == ['master', 'oven', 'postage']
+    assert data['children'][0]['label_i18n']['en'] == 'Master'
+    assert data['total_children'] == 8
+
+    webui.lektor_info.get_builder().update_all_source_infos()
+    rv = client.get('/admin/api/recordinfo?path=/projects&offset=6'
+                    '&lightweight=1')
+    data = json.loads(rv.data)
+    assert data['children'] == [
+        {'id': 'wolf', 'path': '/projects/wolf', 'label': 'wolf',
+         'label_i18n': {'en': 'Wolf'}, 'visible': None},
+        {'id': 'zaun', 'path': '/projects/zaun', 'label': 'zaun',
+         'label_i18n': {'en': 'Zaun'}, 'visible': None},
+    ]
+